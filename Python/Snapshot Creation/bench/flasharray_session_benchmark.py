@@ -0,0 +1,130 @@
+##################################################################################################
+#                                                                                                #
+#                  Pure Storage Inc. (2024) FlashArray REST session benchmark                    #
+#     Measures REST calls per second against a local HTTPS stub with and without the pooled      #
+#                                    keep-alive session                                          #
+#                                                                                                #
+##################################################################################################
+
+import argparse
+import json
+import os
+import shutil
+import ssl
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import requests
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+
+from purestorage_custom import FlashArray
+
+parser = argparse.ArgumentParser(description='Compare FlashArray REST calls per second against a local HTTPS stub')
+parser.add_argument('-c','--calls', type=int, default=500, help="Number of sequential list_volumes calls per run")
+parser.add_argument('-v','--volumes', type=int, default=10, help="Number of volumes returned by the stub")
+args = parser.parse_args()
+calls = args.calls
+volumes = args.volumes
+
+# calls = 500
+# volumes = 10
+
+# The stub answers the REST version , API token , session and volume requests that the client makes and keeps
+# connections open between requests in the same way as the array does
+class FlashArrayStubHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    disable_nagle_algorithm = True
+    volume_list = []
+
+    def _reply(self, content, cookie=None):
+        body = json.dumps(content).encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        if cookie is not None:
+            self.send_header("Set-Cookie", cookie)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _handle(self):
+        length = int(self.headers.get("Content-Length") or 0)
+        if length > 0:
+            self.rfile.read(length)
+        if self.path.endswith("/api_version"):
+            self._reply({"version": ["1.18"]})
+        elif self.path.endswith("/auth/apitoken"):
+            self._reply({"api_token": "benchmark"})
+        elif self.path.endswith("/auth/session"):
+            self._reply({"username": "benchmark"}, "session=benchmark; Path=/")
+        else:
+            self._reply(self.volume_list, "session=benchmark; Path=/")
+
+    do_GET = _handle
+    do_POST = _handle
+    do_DELETE = _handle
+
+    def log_message(self, format, *args):
+        pass
+
+# Before the pooled session every call went through requests.request , which opens and closes its own connection
+class PerRequestSession:
+
+    def request(self, method, url, **kwargs):
+        return requests.request(method, url, **kwargs)
+
+    def close(self):
+        pass
+
+class PerRequestFlashArray(FlashArray):
+
+    def _create_http_session(self):
+        return PerRequestSession()
+
+# This method creates a self signed certificate for the stub in a temporary directory
+def create_certificate(directory):
+    certfile = os.path.join(directory, "stub.crt")
+    keyfile = os.path.join(directory, "stub.key")
+    subprocess.run(["openssl", "req", "-x509", "-newkey", "rsa:2048", "-nodes", "-days", "1",
+                    "-subj", "/CN=localhost", "-keyout", keyfile, "-out", certfile],
+                   check=True, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    return certfile, keyfile
+
+def start_stub_server(certfile, keyfile):
+    FlashArrayStubHandler.volume_list = [{"name": "volume" + str(i), "serial": "%024X" % i, "size": 1073741824}
+                                         for i in range(volumes)]
+    server = ThreadingHTTPServer(("127.0.0.1", 0), FlashArrayStubHandler)
+    context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+    context.load_cert_chain(certfile, keyfile)
+    server.socket = context.wrap_socket(server.socket, server_side=True)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+def measure(array_class, target):
+    array = array_class(target, api_token="benchmark", rest_version="1.18")
+    start = time.monotonic()
+    for i in range(calls):
+        array.list_volumes()
+    elapsed = time.monotonic() - start
+    array.invalidate_cookie()
+    return calls / elapsed
+
+directory = tempfile.mkdtemp()
+try:
+    certfile, keyfile = create_certificate(directory)
+    server = start_stub_server(certfile, keyfile)
+    target = "127.0.0.1:" + str(server.server_address[1])
+    requests.packages.urllib3.disable_warnings()
+    per_request_rate = measure(PerRequestFlashArray, target)
+    pooled_rate = measure(FlashArray, target)
+    server.shutdown()
+finally:
+    shutil.rmtree(directory, ignore_errors=True)
+
+print("Sequential list_volumes calls : " + str(calls) + " , volumes per response : " + str(volumes))
+print("Per call requests.request : " + "{:.1f}".format(per_request_rate) + " calls per second")
+print("Pooled keep-alive session : " + "{:.1f}".format(pooled_rate) + " calls per second")
+print("Speedup : " + "{:.1f}".format(pooled_rate / per_request_rate) + "x")
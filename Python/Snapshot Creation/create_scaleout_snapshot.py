@@ -9,13 +9,20 @@
 
 import sys
 import argparse
-import paramiko
-import re
+import threading
+import time
 import purestorage_custom
 from passwords import DB_Password, OS_Password, SID_Password, vCenter_Password, FlashArray_Password
-from hdbcli import dbapi
+from saphana_connection import SAPHANAConnection
+from saphana_topology import probe_saphana_topology
 from datetime import datetime
-from vsphere import vsphere_get_vvol_disk_identifiers
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from vsphere import VSphereResolver
+from host_connections import SSHConnectionPool
+from device_resolver import probe_host_inventory
+from filesystem_freeze import FilesystemFreeze, FreezeBarrier
+from volume_resolver import VolumeSerialIndex, normalize_serial
+from topology_cache import TopologyCache
 
 #Arguments
 parser = argparse.ArgumentParser(description='Process the creation of an SAP \
@@ -54,6 +61,16 @@ parser.add_argument('-vcu','--vcenteruser', help='The Username of a user for the
     Server managing the SAP HANA VM ', required=False, default=None)
 parser.add_argument('-vcp','--vcenterpassword', type=vCenter_Password, help='The Password of a user for the vCenter\
     Server managing the SAP HANA VM ', default=vCenter_Password.DEFAULT_vCenter_Password)
+parser.add_argument('-ph','--parallelhosts', type=int, default=8,\
+     help='The maximum number of hosts to run discovery operations on at the same time , filesystems are always frozen and thawed on every host at once',required=False)
+parser.add_argument('-swb','--snapshotwindowbudget', type=float, default=None,\
+     help='Warn if SAP HANA stays in the prepared snapshot state for longer than this number of seconds',required=False)
+parser.add_argument('-mfd','--maxfreezeduration', type=float, default=30,\
+     help='The maximum number of seconds a filesystem stays frozen , after which it is thawed and the snapshot fails',required=False)
+parser.add_argument('-fat','--freezealertthreshold', type=float, default=1.0,\
+     help='Warn if a filesystem stays frozen for longer than this number of seconds',required=False)
+parser.add_argument('-ntc','--notopologycache', action="store_true",\
+     help='Always discover the volume topology of the hosts instead of using the on disk cache',required=False)
 parser.add_argument('--version', action='version', version='%(prog)s 0.5')
 
 args = parser.parse_args()
@@ -73,6 +90,11 @@ freezefilesystem = args.freezefilesystem
 vcenteraddress = args.vcenteraddress
 vcenteruser = args.vcenteruser
 vcenterpassword = args.vcenterpassword.value
+notopologycache = args.notopologycache
+maxfreezeduration = args.maxfreezeduration
+freezealertthreshold = args.freezealertthreshold
+parallelhosts = args.parallelhosts
+snapshotwindowbudget = args.snapshotwindowbudget
 
 # hostaddress = ""
 # domainname = ""
@@ -91,6 +113,28 @@ port = "13"
 # vcenterpassword = ""
 # crashconsistent = False
 # freezefilesystem = False
+# maxfreezeduration = 30
+# freezealertthreshold = 1.0
+
+# SAP HANA connections are opened once per port and closed when the run finishes
+saphana_connections = {}
+# The SAP HANA topology is only queried once per run
+saphana_topology = None
+# product_uuid is only readable by root , sudo is used if the operating system user is not root
+VM_UUID_COMMAND = "cat /sys/class/dmi/id/product_uuid 2>/dev/null || sudo -n /usr/bin/cat /sys/class/dmi/id/product_uuid"
+# SSH connections to each host are opened once and reused for the whole run
+ssh_pool = SSHConnectionPool()
+# A single FlashArray REST session is opened for the run and shared by every host thread
+flasharray_client = None
+flasharray_client_lock = threading.Lock()
+# The FlashArray volume serial number index is only built once per run , even when requested from several host threads
+volume_index = None
+volume_index_lock = threading.Lock()
+# One vCenter session and inventory is shared by the lookups for every host
+vsphere_resolver = None
+vsphere_resolver_lock = threading.Lock()
+# The resolved host volume topology is cached on disk between runs unless disabled
+topology_cache = None if notopologycache else TopologyCache()
 
 # This method is responsible for ensuring that the version of Python be used is 3 or higher
 def check_pythonversion():
@@ -99,124 +143,108 @@ def check_pythonversion():
 
 # This method takes any SQL command for SAP HANA and sends it to the relevant service. 
 # The port number is included to ensure connections are made to the SYSTEMDB
+# A single connection is kept open for each port and reused for the whole run
 def execute_saphana_command(command, port_number):
     portvalue = "3" + str(instancenumber) + str(port_number)
-    connection = dbapi.connect(address=hostaddress,
-                port=portvalue,
-                user=databaseuser,
-                password=databasepassword)
-    if(connection.isconnected):
-        cursor = connection.cursor()
-        cursor.execute(command)
-        responses = list()
-        if cursor.description is not None:
-            for row in cursor:
-                responses.append(row)
-            return responses
-        else:
-            pass
-    else:
-            print("Database connection not possible")
+    connection = saphana_connections.get(portvalue)
+    if connection is None:
+        connection = saphana_connections.setdefault(portvalue, SAPHANAConnection(hostaddress, portvalue, \
+            databaseuser, databasepassword))
+    return connection.execute(command)
+
+# The SID , persistence locations , attached storage and nameserver are read from SAP HANA in one query and reused for the run
+def get_saphana_topology():
+    global saphana_topology
+    if saphana_topology is None:
+        saphana_topology = probe_saphana_topology(lambda command: execute_saphana_command(command, port))
+    return saphana_topology
 
 # When the instance ID is required this method returnes the 3 character SID of the HANA platform
 def get_saphana_instanceid():
-    hdbsqlGetSAPHANAInstanceID = "SELECT VALUE from SYS.M_SYSTEM_OVERVIEW WHERE NAME = 'Instance ID'"
-    instanceid =  execute_saphana_command(hdbsqlGetSAPHANAInstanceID,port)
-    instanceid = instanceid[0].column_values[0]
-    return instanceid
+    return get_saphana_topology().sid
+
+# The FlashArray REST session is established on first use , normally during discovery and before SAP HANA is prepared
+# The client is shared by the host threads , its connection pool holds a connection for every parallel host and one
+# for the page prefetch
+def get_flasharray():
+    global flasharray_client
+    with flasharray_client_lock:
+        if flasharray_client is None:
+            flasharray_client = purestorage_custom.FlashArray(flasharray,flasharrayuser, flasharraypassword,verify_https=False, \
+                pool_size=max(1, parallelhosts) + 1)
+    return flasharray_client
+
+# The volumes on the FlashArray are listed once per run , page by page , and indexed by serial number , every later lookup
+# from any host thread is answered from the index. Only the current and the prefetched page are held while the index is
+# built and the index itself keeps just the volume name for each serial number
+def get_volume_index(array):
+    global volume_index
+    with volume_index_lock:
+        if volume_index is None:
+            volume_index = VolumeSerialIndex(array.iter_volumes())
+    return volume_index
 
 # When bash commands need to be run this method is triggered
+# The SSH transport to the host is opened once and shared by every command through the connection pool
+# Commands for the local machine , run as the user running the script , are run directly without SSH
 def prepare_ssh_connection(host):
-    sshclient = paramiko.SSHClient()
-    sshclient.set_missing_host_key_policy(paramiko.AutoAddPolicy())
-    sshclient.connect(
-        host,
-        port=22,
-        username=operatingsystemuser,
-        password=operatingsystempassword
-    )
-    return sshclient
+    return ssh_pool.connection(host, operatingsystemuser, operatingsystempassword)
 
-# This method helps to identify the volume name 
-# To create a block storage snapshot the volume name is used with the Pure Storage RESTFul API
-def get_volume_serialno(host,volume_mount):
+# A virtual machine can read its own BIOS UUID , this lets vCenter find the virtual machine directly instead of searching the inventory
+# None is returned if the UUID cannot be read , in which case the inventory is searched
+def get_vm_uuid(host):
     sshclient = prepare_ssh_connection(host)
-    get_volumemountpoint_command = "df -h | grep " + str(volume_mount)
-    stdin, stdout, stderr = sshclient.exec_command(get_volumemountpoint_command)
-    opt = stdout.readlines()
-    parsedvolume_location = re.search("([^[']\S+)",str(opt))
-    get_volumeserialno_command = "udevadm info --query=all --name=" + \
-    str(parsedvolume_location.group()) + " | grep DM_SERIAL"
-    stdin, stdout, stderr = sshclient.exec_command(get_volumeserialno_command)
+    stdin, stdout, stderr = sshclient.exec_command(VM_UUID_COMMAND)
     opt = stdout.readlines()
-    volumeserial_toparse = opt
     sshclient.close()
-    volumeserial_toparse = re.split("=",str(volumeserial_toparse))
-    volumeserial_toparse = volumeserial_toparse[1]
-    volumeserial_toparse = re.split("\\\\",str(volumeserial_toparse))
-    volumeserial = volumeserial_toparse[0]
-    return volumeserial
+    if len(opt) == 0 or len(opt[0].strip()) == 0:
+        return None
+    return opt[0].strip()
 
-# If specific the filesystem can have IO frozen to ensure no further write operations occur while the snapshot is being taken
-def freeze_filesystem(host,volume_mount):
+# A single probe on the host returns its fingerprint and the device , world wide ID and size of every mount holding or below
+# the SAP HANA persistence base paths , however many volumes a host has it costs one round trip
+# Each volume mount point is then resolved from that table of mounts
+def get_host_inventory(host):
+    topology = get_saphana_topology()
+    basepaths = [basepath for basepath in (topology.data_basepath, topology.log_basepath) if basepath is not None]
     sshclient = prepare_ssh_connection(host)
-    get_volumemountpoint_command = "sudo /sbin/fsfreeze --freeze" + str(volume_mount)
-    stdin, stdout, stderr = sshclient.exec_command(get_volumemountpoint_command)
-    opt = stdout.readlines()
+    inventory = probe_host_inventory(sshclient, (), basepaths)
     sshclient.close()
+    return inventory
 
-def unfreeze_filesystem(host,volume_mount):
-    sshclient = prepare_ssh_connection(host)
-    get_volumemountpoint_command = "sudo /sbin/fsfreeze --unfreeze" + str(volume_mount)
-    stdin, stdout, stderr = sshclient.exec_command(get_volumemountpoint_command)
-    opt = stdout.readlines()
-    sshclient.close()
+# In order to match the volumes presented to the operating system the world wide ID of each mount point is identified
+def get_volume_serialnos(inventory, host, volume_mounts):
+    serialnumbers = []
+    for volume_mount in volume_mounts:
+        serialnumber = inventory.get_wwid(volume_mount)
+        if serialnumber is None:
+            raise NameError('The world wide ID of the volume mounted at ' + str(volume_mount) + ' on ' + str(host) + \
+                ' could not be found')
+        serialnumbers.append(serialnumber)
+    return serialnumbers
 
-# This method takes the volume serial number , matches it against a volume on the selected flasharray and then takes a storage snapshot
-# If the volume world wide ID string matches the VMware vendor string , then the vcenter credentials are used to check if vvols are being used
-# VMFS based virtual disks are not supported - only vVols
-def create_flasharray_volume_snapshot(serialnumber,snapshot_suffix):
-    array = purestorage_custom.FlashArray(flasharray,flasharrayuser, flasharraypassword,verify_https=False)
-    snapserial = None
-    vendor_string = serialnumber[0 : 8]
-    # This is a disk directly attached to the host
-    if(vendor_string == '3624a937'):
-        volumes =  array.list_volumes()
-        for key in volumes:
-            volname = key.get("name")
-            volserial = str(key.get("serial")).lower()
-            found = volserial.lower() in serialnumber.lower()
-            if found:
-                snapshot_id = array.create_snapshot(volname, suffix=snapshot_suffix)
-                snapserial = str(snapshot_id.get("serial"))
-                return snapserial
-    elif(vendor_string == '36000c29'):
-        # Then this is a VMware vdisk volume ,need to check if it is vvol based
-        vm_disk_info = None
-        if(vcenteraddress is not None and vcenteruser is not None and vcenterpassword is not None):
-            vcenter_dict = {'address':vcenteraddress,'vc_user':vcenteruser,'vc_pass':vcenterpassword}
-        else:
-            raise NameError('The volume has been detected to be a virtual disk but no vCenter credentials have been supplied to further parse the request')
-        vm_disk_info = vsphere_get_vvol_disk_identifiers(serialnumber,vcenter_dict)
-        if vm_disk_info is not None:
-            volume = array.list_virtual_volume(vm_disk_info.get('backingObjectId'))
-            if(volume.__len__() != 0):
-                for attr in volume:
-                    if(attr.get('key') == 'PURE_VVOL_ID'):
-                        volname = attr.get('name')
-                        vol = array.get_volume(volname)
-                        vvolvolserial = vol.get('serial')
-                        volumes =  array.list_volumes()
-                        for key in volumes:
-                            volname = key.get("name")
-                            volserial = str(key.get("serial")).lower()
-                            found = volserial.lower() in vvolvolserial.lower()
-                            if found:
-                                snapshot_id = array.create_snapshot(volname, suffix=snapshot_suffix)
-                                snapserial = str(snapshot_id.get("serial"))
-                                return snapserial
-    if(snapserial is None):
-         raise NameError('The volume was not found on this array or this is not a supported volume for a data snapshot')
+# If specific the filesystem can have IO frozen to ensure no further write operations occur while the snapshot is being taken
+# The thaw is armed on the host before the filesystem is frozen and is carried out at the latest once the maximum
+# freeze duration has passed
+def create_filesystem_freeze(host,volume_mount):
+    return FilesystemFreeze(prepare_ssh_connection(host), volume_mount, maxfreezeduration, host)
+
+# Every filesystem on every host is frozen at the same time , once all freezes have been acknowledged the snapshot is
+# taken and all filesystems are thawed together again , even if the snapshot fails or the maximum freeze duration
+# passes. How long each filesystem was frozen is reported afterwards
+def create_snapshot_with_frozen_filesystems(host_mounts, create_snapshot):
+    freezes = []
+    if(freezefilesystem == True):
+        freezes = [create_filesystem_freeze(host, volume_mount) for host, volume_mount in host_mounts]
+    with FreezeBarrier(freezes, freezealertthreshold):
+        return create_snapshot()
+
+# This method takes the names of the volumes resolved from the data volume mount points and snapshots all of them in a single request
+# The array creates every snapshot at the same point in time , giving one consistent image across the whole cluster
+def create_flasharray_volume_snapshots(volnames,snapshot_suffix):
+    array = get_flasharray()
+    snapshots = array.create_snapshots(volnames, suffix=snapshot_suffix)
+    return snapshots
 
 # The SAP HANA data snapshot must be prepared before taking a block volume snapshot , this sends the SQL command to the platform to do so. 
 def prepare_saphana_storage_snapshot():
@@ -247,27 +275,18 @@ def abandon_saphana_storage_snapshot(BackupID, EBID):
 # To create a block storage snapshot the volume name is used with the Pure Storage RESTFul API
 # This method will use the vendor string to check if the volume is direct attached from the FlashArray 
 # or if it is a VMware virtua disk
-def get_volume_name(serialno):
-    array = purestorage_custom.FlashArray(flasharray,flasharrayuser, flasharraypassword,verify_https=False)
+def get_volume_name(serialno, vvol_disks):
+    array = get_flasharray()
     vendor_string = serialno[0 : 8]
     volname = None
     if(vendor_string == '3624a937'):
-        volumes =  array.list_volumes()
-        for key in volumes:
-            volname = key.get("name")
-            volserial = str(key.get("serial")).lower()
-            found = volserial in serialno
-            if found:
-                return volname
+        volname = get_volume_index(array).get_volume_name(serialno)
+        if volname is not None:
+            return volname
     elif(vendor_string == '36000c29'):
              # Then this is a VMware vdisk volume ,need to check if it is vvol based
-            vm_disk_info = None
-            array = purestorage_custom.FlashArray(flasharray,flasharrayuser, flasharraypassword,verify_https=False)
-            if(vcenteraddress is not None and vcenteruser is not None and vcenterpassword is not None):
-                vcenter_dict = {'address':vcenteraddress,'vc_user':vcenteruser,'vc_pass':vcenterpassword}
-            else:
-                raise NameError('The volume has been detected to be a virtual disk but no vCenter credentials have been supplied to further parse the request')
-            vm_disk_info = vsphere_get_vvol_disk_identifiers(serialno,vcenter_dict)
+            array = get_flasharray()
+            vm_disk_info = vvol_disks.get(serialno)
             if vm_disk_info is not None:
                 volume = array.list_virtual_volume(vm_disk_info.get('backingObjectId'))
                 if(volume.__len__() != 0):
@@ -276,72 +295,174 @@ def get_volume_name(serialno):
                             volname = attr.get('name')
                             vol = array.get_volume(volname)
                             vvolvolserial = vol.get('serial')
-                            volumes_toparse =  array.list_volumes()
-                            for key in volumes_toparse:
-                                thisvolname = key.get("name")
-                                thisvolserial = str(key.get("serial")).lower()
-                                found = thisvolserial.lower() in vvolvolserial.lower()
-                                if found:
-                                    volname = thisvolname
-                                    return volname
+                            thisvolname = get_volume_index(array).get_volume_name(vvolvolserial)
+                            if thisvolname is not None:
+                                volname = thisvolname
+                                return volname
     return volname
 
 # SAP HANA keeps track of the data volumes , this method will query the platform to return the location of the data volumes 
 # When using an application consistent data snapshot only the data volume is needed as the process will trigger a savepoint 
 # Recovery will nullify all transaction logs 
 def get_saphana_data_volume_and_hosts():
-    hdbGetHANADataVolumeAndHosts = "SELECT HOST, STORAGE_ID, PATH, KEY, VALUE FROM SYS.M_ATTACHED_STORAGES WHERE KEY = \
-    'WWID' AND PATH LIKE (SELECT CONCAT(VALUE,'%') FROM M_INIFILE_CONTENTS WHERE FILE_NAME = 'global.ini' AND SECTION = \
-    'persistence' AND KEY = 'basepath_datavolumes' AND VALUE NOT LIKE '$%')"
-    hosts_data_volumes = execute_saphana_command(hdbGetHANADataVolumeAndHosts, port)
-    return hosts_data_volumes
+    return get_saphana_topology().data_volume_storages()
 
 # In a scale out environment the nameserver needs to be identified as that is where the SystemDB runs
 def get_saphana_nameserver_host():
-    hdbGetNameServerhost = "SELECT HOST FROM SYS.M_SERVICES WHERE DETAIL = 'master' AND SERVICE_NAME = 'nameserver'"
-    nameserver_host = execute_saphana_command(hdbGetNameServerhost, port)
-    nameserver_host = nameserver_host[0].column_values[0]
-    return nameserver_host
+    return get_saphana_topology().nameserver_host
+
+# The vCenter resolver is created on first use and shared by the host threads
+def get_vsphere_resolver():
+    global vsphere_resolver
+    with vsphere_resolver_lock:
+        if vsphere_resolver is None:
+            if(vcenteraddress is not None and vcenteruser is not None and vcenterpassword is not None):
+                vcenter_dict = {'address':vcenteraddress,'vc_user':vcenteruser,'vc_pass':vcenterpassword}
+            else:
+                raise NameError('The volume has been detected to be a virtual disk but no vCenter credentials have been supplied to further parse the request')
+            vsphere_resolver = VSphereResolver(vcenter_dict)
+    return vsphere_resolver
+
+# Every virtual disk serial number on a host is resolved against vCenter together , the hosts are resolved
+# concurrently over one vCenter session and the virtual machine inventory is retrieved at most once
+def get_vvol_disks(host, serialnumbers):
+    vvol_serials = [serialno for serialno in serialnumbers if serialno[0 : 8] == '36000c29']
+    if len(vvol_serials) == 0:
+        return {}
+    return get_vsphere_resolver().resolve(vvol_serials, get_vm_uuid(host))
+
+# A cached topology is only used if the world wide ID just probed for every mount point is still the one that was recorded
+def cached_volumes_match_inventory(volumes, inventory):
+    for volume in volumes:
+        if inventory.get_wwid(volume.get('mountpoint')) != volume.get('serialnumber'):
+            return False
+    return True
+
+# A cached topology is only used if every volume still exists on the array with the serial number that was recorded
+def volumes_present_on_array(volumes):
+    array = get_flasharray()
+    for volume in volumes:
+        try:
+            arrayvolume = array.get_volume(volume.get('volumename'))
+        except purestorage_custom.PureError:
+            return False
+        if normalize_serial(arrayvolume.get('serial')) != volume.get('volumeserial'):
+            return False
+    return True
+
+# Each mount point on a host is resolved to its world wide ID and FlashArray volume
+# The result is kept in the topology cache so that a later run on an unchanged host can skip discovery
+def resolve_host_volumes(host, mounts):
+    instanceid = get_saphana_instanceid()
+    inventory = get_host_inventory(host)
+    fingerprint = inventory.fingerprint
+    if topology_cache is not None:
+        volumes = topology_cache.load(instanceid, host, fingerprint, mounts)
+        if volumes is not None:
+            if cached_volumes_match_inventory(volumes, inventory) and volumes_present_on_array(volumes):
+                return volumes
+            topology_cache.invalidate(instanceid, host)
+    array = get_flasharray()
+    serialnumbers = get_volume_serialnos(inventory, host, mounts)
+    vvol_disks = get_vvol_disks(host, serialnumbers)
+    volumes = []
+    for mount, serialNumber in zip(mounts, serialnumbers):
+        volname = get_volume_name(serialNumber, vvol_disks)
+        if (volname == None):
+            raise NameError('The volume was not found on this array')
+        volserial = normalize_serial(array.get_volume(volname).get('serial'))
+        volumedata = {'host' : host, 'mountpoint': mount, \
+        'serialnumber': serialNumber, 'volumename' : volname, 'volumeserial' : volserial}
+        volumes.append(volumedata)
+    if topology_cache is not None:
+        topology_cache.store(instanceid, host, fingerprint, volumes)
+    return volumes
 
 # SAP HANA keeps track of the data and log volumes , this method will query the platform to return the location of the log and data volumes 
 # When using a crash consistent storage snapshot both the data and log volumes are required
 def get_persistence_volumes_location():
-    hdbGetPersistenceDataVolumesLocation = "SELECT HOST, STORAGE_ID, PATH, KEY, VALUE FROM SYS.M_ATTACHED_STORAGES \
-                WHERE KEY = 'WWID' AND PATH LIKE (SELECT CONCAT(VALUE,'%') FROM M_INIFILE_CONTENTS WHERE FILE_NAME \
-                = 'global.ini' AND SECTION = 'persistence' AND KEY = 'basepath_datavolumes' AND VALUE NOT LIKE '$%')"
-    hdbGetPersistenceLogVolumesLocation = "SELECT HOST, STORAGE_ID, PATH, KEY, VALUE FROM SYS.M_ATTACHED_STORAGES \
-                WHERE KEY = 'WWID' AND PATH LIKE (SELECT CONCAT(VALUE,'%') FROM M_INIFILE_CONTENTS WHERE FILE_NAME\
-                = 'global.ini' AND SECTION = 'persistence' AND KEY = 'basepath_logvolumes' AND VALUE NOT LIKE '$%')"
-    persistenceDataVolumes = execute_saphana_command(hdbGetPersistenceDataVolumesLocation, port)
-    persistenceLogVolumes = execute_saphana_command(hdbGetPersistenceLogVolumesLocation, port)
+    topology = get_saphana_topology()
+    host_mounts = {}
+    for storage in topology.data_volume_storages() + topology.log_volume_storages():
+        host_mounts.setdefault(storage.host, []).append(storage.path)
+    host_items = [{'host' : host, 'mountpoints' : host_mounts[host]} for host in host_mounts]
     volumes = []
-    for item in persistenceDataVolumes:
-        mount = item.column_values[2]
-        serialNumber = get_volume_serialno(item.column_values[0],mount)
-        volname = get_volume_name(serialNumber)
-        if (volname == None):
-            raise NameError('The volume was not found on this array')
-        else:
-            volumedata = {'host' : item[0], 'mountpoint': mount, \
-            'serialnumber': serialNumber, 'volumename' : volname}
-            volumes.append(volumedata)
-    for item in persistenceLogVolumes:
-        mount = item.column_values[2]
-        serialNumber = get_volume_serialno(item.column_values[0],mount)
-        volname = get_volume_name(serialNumber)
-        if (volname == False):
-            raise NameError('The volume was not found on this array')
-        else:
-            volumedata = {'host' : item[0], 'mountpoint': mount, \
-            'serialnumber': serialNumber, 'volumename' : volname}
-            volumes.append(volumedata)
+    for host_volumes in run_on_hosts(resolve_host_item_volumes, host_items):
+        volumes.extend(host_volumes)
     return volumes
 
+# The data volume rows returned by SAP HANA are grouped per host so that each host is only worked on by a single thread
+def get_data_volume_host_items(hosts_and_vols):
+    host_items = {}
+    for h_v in hosts_and_vols:
+        host = h_v.host + "."  + domainname
+        host_item = host_items.setdefault(host, {'host' : host, 'hostname' : h_v.host, 'mountpoints' : []})
+        host_item.get('mountpoints').append(h_v.path)
+    return list(host_items.values())
+
+# This method runs an operation for every host concurrently , with at most parallelhosts hosts being worked on at once
+# An error on one host does not stop the others , all errors are collected and reported per host once every host has finished
+def run_on_hosts(operation, host_items, *args):
+    results = [None] * len(host_items)
+    errors = []
+    with ThreadPoolExecutor(max_workers=max(1, parallelhosts)) as executor:
+        futures = {}
+        for index, host_item in enumerate(host_items):
+            futures[executor.submit(operation, host_item, *args)] = index
+        for future in as_completed(futures):
+            index = futures[future]
+            try:
+                results[index] = future.result()
+            except Exception as e:
+                errors.append("host " + str(host_items[index].get('host')) + " : " + str(e))
+    if errors:
+        raise NameError('The operation failed on ' + str(len(errors)) + ' host(s) - ' + " ; ".join(errors))
+    return results
+
+def resolve_host_item_volumes(host_item):
+    return resolve_host_volumes(host_item.get('host'), host_item.get('mountpoints'))
+
+# Every data volume in the cluster is snapshotted together once all of them have been resolved
+# If requested the filesystems on all hosts are frozen for the snapshot and are always thawed again , even if the snapshot fails
+# or the maximum freeze duration passes , in which case the snapshot is reported as failed
+def create_data_volume_snapshots(host_items, volumes, saphana_backup_id):
+    vol_snap_suffix = "SAPHANA-" + str(saphana_backup_id)
+    for volume in volumes:
+        print("Creating storage snapshot for mount point : " + volume.get('mountpoint') + " on host : " + volume.get('host'))
+    host_mounts = [(host_item.get('host'), mount_point) for host_item in host_items for mount_point in host_item.get('mountpoints')]
+    snapshots = create_snapshot_with_frozen_filesystems(host_mounts, \
+        lambda: create_flasharray_volume_snapshots([volume.get('volumename') for volume in volumes], vol_snap_suffix))
+    volume_snapshot_id = ""
+    for snap in snapshots:
+        volume_snapshot_id = volume_snapshot_id + "-" + str(snap.get("name")) + "-" + str(snap.get("serial"))
+    return volume_snapshot_id
+
+# Phase 1 of an application consistent snapshot , run before SAP HANA is prepared
+# Every host and data volume is resolved and validated , and the SSH and FlashArray sessions used later are opened
+def discover_data_volume_snapshot_targets():
+    hosts_and_vols = get_saphana_data_volume_and_hosts()
+    if len(hosts_and_vols) == 0:
+        raise NameError('No SAP HANA data volumes were found in M_ATTACHED_STORAGES')
+    host_items = get_data_volume_host_items(hosts_and_vols)
+    data_volumes = []
+    for host_volumes in run_on_hosts(resolve_host_item_volumes, host_items):
+        data_volumes.extend(host_volumes)
+    get_flasharray()
+    return host_items, data_volumes
+
+# The time SAP HANA spent in the prepared snapshot state is reported , with a warning if it exceeded the budget
+def report_snapshot_window(window_start):
+    window_duration = time.monotonic() - window_start
+    print("SAP HANA prepared snapshot window : " + "{:.3f}".format(window_duration) + " seconds")
+    if snapshotwindowbudget is not None and window_duration > snapshotwindowbudget:
+        print("WARNING : The prepared snapshot window exceeded the budget of " + str(snapshotwindowbudget) + " seconds")
+    return window_duration
+
 # If using crash consistency then the volumes are added to a protection group and a protection group snap is created
 def create_protection_group_snap(volumes):
     instanceid = get_saphana_instanceid()
     pgname = "SAPHANA-" + instanceid + "-CrashConsistency"
-    array = purestorage_custom.FlashArray(flasharray,flasharrayuser, flasharraypassword,verify_https=False)
+    array = get_flasharray()
     try:
         pgroup = array.get_pgroup(pgname)
     except Exception:
@@ -354,38 +475,27 @@ def create_protection_group_snap(volumes):
 
 # This is the equivalent of the "Main" method where execution is run
 try:
+    saphana_backup_id = None
+    window_start = None
     check_pythonversion()
     if(crashconsistent == False):
-        hosts_and_vols = get_saphana_data_volume_and_hosts()
+        # Phase 1 : discovery and validation
+        host_items, data_volumes = discover_data_volume_snapshot_targets()
+        # Phase 2 : only prepare , freeze , snapshot , thaw and confirm run while SAP HANA is in the prepared state
+        window_start = time.monotonic()
         saphana_backup_id = prepare_saphana_storage_snapshot()
-        volume_snapshot_id = ""
-        for h_v in hosts_and_vols:
-            host = h_v.column_values[0] + "."  + domainname
-            mount_point = h_v.column_values[2]
-            if(freezefilesystem == True):
-                freeze_filesystem(host, mount_point)
-            mount_point_parse = mount_point.replace('/',"")
-            vol_snap_suffix = "SAPHANA-" + h_v.column_values[0] + "-" + mount_point_parse + "-"  + str(saphana_backup_id)
-            print("Creating storage snapshot for mount point : " + mount_point_parse + " on host : " + host)
-            volume_snapshot_id = volume_snapshot_id + "-" + vol_snap_suffix + "-" + \
-            create_flasharray_volume_snapshot(get_volume_serialno(host, mount_point),vol_snap_suffix)
-            if(freezefilesystem == True):
-                unfreeze_filesystem(host, mount_point)
+        volume_snapshot_id = create_data_volume_snapshots(host_items, data_volumes, saphana_backup_id)
         if saphana_backup_id is not None and volume_snapshot_id is not None:
             print("Confirming storage snapshot with SAP HANA Backup ID : " + str(saphana_backup_id))
             confirm_saphana_storage_snapshot(saphana_backup_id, volume_snapshot_id)
         else:
             print("Abandoning storage snapshot with SAP HANA Backup ID : " + str(saphana_backup_id))
             abandon_saphana_storage_snapshot(saphana_backup_id, "no_value")
+        report_snapshot_window(window_start)
     else:
         formattedvolumes = get_persistence_volumes_location()
-        for volume in formattedvolumes:
-            if(freezefilesystem == True):
-                freeze_filesystem(volume.get('host'),volume.get('mountpoint'))
-        snapname = create_protection_group_snap(formattedvolumes)
-        for volume in formattedvolumes:
-            if(freezefilesystem == True):
-                unfreeze_filesystem(volume.get('host'),volume.get('mountpoint'))
+        snapname = create_snapshot_with_frozen_filesystems([(volume.get('host'), volume.get('mountpoint')) for volume in formattedvolumes], \
+            lambda: create_protection_group_snap(formattedvolumes))
         print ("Crash consistent storage snapshot " + snapname.get('name') + " created")
 except Exception as e:
     print(e)
@@ -396,4 +506,6 @@ except Exception as e:
                 abandon_saphana_storage_snapshot(saphana_backup_id, "no_value")
             except Exception as e:
                 print(e)
+        if window_start is not None:
+            report_snapshot_window(window_start)
     
@@ -9,13 +9,17 @@
 
 import sys
 import argparse
-import paramiko
-import re
 from pypureclient import flasharray
 from passwords import DB_Password, OS_Password, SID_Password, vCenter_Password, FlashArray_Password
-from hdbcli import dbapi
+from saphana_connection import SAPHANAConnection
+from saphana_topology import probe_saphana_topology
 from datetime import datetime
-from vsphere import vsphere_get_vvol_disk_identifiers
+from vsphere import vsphere_get_vvol_disk_identifiers_batch
+from host_connections import SSHConnectionPool
+from device_resolver import probe_host_inventory
+from filesystem_freeze import FilesystemFreeze, FreezeBarrier
+from volume_resolver import VolumeSerialIndex, normalize_serial
+from topology_cache import TopologyCache
 
 # #Arguments
 parser = argparse.ArgumentParser(description='Process the creation of an SAP \
@@ -52,6 +56,12 @@ parser.add_argument('-vcu','--vcenteruser', help='The Username of a user for the
     Server managing the SAP HANA VM ', required=False, default=None)
 parser.add_argument('-vcp','--vcenterpassword', type=vCenter_Password, help='The Password of a user for the vCenter\
     Server managing the SAP HANA VM ', default=vCenter_Password.DEFAULT_vCenter_Password)
+parser.add_argument('-mfd','--maxfreezeduration', type=float, default=30,\
+     help='The maximum number of seconds a filesystem stays frozen , after which it is thawed and the snapshot fails',required=False)
+parser.add_argument('-fat','--freezealertthreshold', type=float, default=1.0,\
+     help='Warn if a filesystem stays frozen for longer than this number of seconds',required=False)
+parser.add_argument('-ntc','--notopologycache', action="store_true",\
+     help='Always discover the volume topology of the host instead of using the on disk cache',required=False)
 parser.add_argument('--version', action='version', version='%(prog)s 1.0')
 
 args = parser.parse_args()
@@ -70,6 +80,9 @@ freezefilesystem = args.freezefilesystem
 vcenteraddress = args.vcenteraddress
 vcenteruser = args.vcenteruser
 vcenterpassword = args.vcenterpassword.value
+notopologycache = args.notopologycache
+maxfreezeduration = args.maxfreezeduration
+freezealertthreshold = args.freezealertthreshold
 
 # hostaddress = ""
 # instancenumber = ""
@@ -87,6 +100,21 @@ port = "13"
 # vcenterpassword = ""
 # crashconsistent = False
 # freezefilesystem = False
+# maxfreezeduration = 30
+# freezealertthreshold = 1.0
+
+# SAP HANA connections are opened once per port and closed when the run finishes
+saphana_connections = {}
+# The SAP HANA topology is only queried once per run
+saphana_topology = None
+# product_uuid is only readable by root , sudo is used if the operating system user is not root
+VM_UUID_COMMAND = "cat /sys/class/dmi/id/product_uuid 2>/dev/null || sudo -n /usr/bin/cat /sys/class/dmi/id/product_uuid"
+# SSH connections to each host are opened once and reused for the whole run
+ssh_pool = SSHConnectionPool()
+# The FlashArray volume serial number index is only built once per run
+volume_index = None
+# The resolved host volume topology is cached on disk between runs unless disabled
+topology_cache = None if notopologycache else TopologyCache()
 
 # This method is responsible for ensuring that the version of Python be used is 3 or higher
 def check_pythonversion():
@@ -97,126 +125,92 @@ def check_pythonversion():
 
 # This method takes any SQL command for SAP HANA and sends it to the relevant service. 
 # The port number is included to ensure connections are made to the SYSTEMDB
+# A single connection is kept open for each port and reused for the whole run
 def execute_saphana_command(command, port_number):
     portvalue = "3" + str(instancenumber) + str(port_number)
-    connection = dbapi.connect(address=hostaddress,
-                port=portvalue,
-                user=databaseuser,
-                password=databasepassword)
-    if(connection.isconnected):
-        cursor = connection.cursor()
-        cursor.execute(command)
-        responses = list()
-        if cursor.description is not None:
-            for row in cursor:
-                responses.append(row)
-            return responses
-        else:
-            pass
-    else:
-            print("Database connection not possible")
+    connection = saphana_connections.get(portvalue)
+    if connection is None:
+        connection = saphana_connections.setdefault(portvalue, SAPHANAConnection(hostaddress, portvalue, \
+            databaseuser, databasepassword))
+    return connection.execute(command)
+
+# The SID , persistence locations , attached storage and nameserver are read from SAP HANA in one query and reused for the run
+def get_saphana_topology():
+    global saphana_topology
+    if saphana_topology is None:
+        saphana_topology = probe_saphana_topology(lambda command: execute_saphana_command(command, port))
+    return saphana_topology
 
 # When the instance ID is required this method returnes the 3 character SID of the HANA platform
 def get_saphana_instanceid():
-    hdbsqlGetSAPHANAInstanceID = "SELECT VALUE from SYS.M_SYSTEM_OVERVIEW WHERE NAME = 'Instance ID'"
-    instanceid =  execute_saphana_command(hdbsqlGetSAPHANAInstanceID,port)
-    instanceid = instanceid[0].column_values[0]
-    return instanceid
+    return get_saphana_topology().sid
+
+# The volumes on the FlashArray are listed once and indexed by serial number , every later lookup is answered from the index
+def get_volume_index(array):
+    global volume_index
+    if volume_index is None:
+        volume_index = VolumeSerialIndex(array.get_volumes().items)
+    return volume_index
 
 # When bash commands need to be run this method is triggered
+# The SSH transport to the host is opened once and shared by every command through the connection pool
+# Commands for the local machine , run as the user running the script , are run directly without SSH
 def prepare_ssh_connection():
-    sshclient = paramiko.SSHClient()
-    sshclient.set_missing_host_key_policy(paramiko.AutoAddPolicy())
-    sshclient.connect(
-        hostaddress,
-        port=22,
-        username=operatingsystemuser,
-        password=operatingsystempassword
-    )
-    return sshclient
+    return ssh_pool.connection(hostaddress, operatingsystemuser, operatingsystempassword)
 
-# In order to match the volume presented to the operating system the serial number is identified from the mount point
-# udev is queried to look at volume information
-def get_volume_serialno(volume_mount):
+# A virtual machine can read its own BIOS UUID , this lets vCenter find the virtual machine directly instead of searching the inventory
+# None is returned if the UUID cannot be read , in which case the inventory is searched
+def get_vm_uuid():
     sshclient = prepare_ssh_connection()
-    get_volumemountpoint_command = "df -h | grep " + str(volume_mount)
-    stdin, stdout, stderr = sshclient.exec_command(get_volumemountpoint_command)
-    opt = stdout.readlines()
-    parsedvolume_location = re.search("([^[']\S+)",str(opt))
-    get_volumeserialno_command = "udevadm info --query=all --name=" + \
-        str(parsedvolume_location.group()) + " | grep DM_SERIAL"
-    stdin, stdout, stderr = sshclient.exec_command(get_volumeserialno_command)
+    stdin, stdout, stderr = sshclient.exec_command(VM_UUID_COMMAND)
     opt = stdout.readlines()
-    volumeserial_toparse = opt
     sshclient.close()
-    volumeserial_toparse = re.split("=",str(volumeserial_toparse))
-    volumeserial_toparse = volumeserial_toparse[1]
-    volumeserial_toparse = re.split("\\\\",str(volumeserial_toparse))
-    volumeserial = volumeserial_toparse[0]
-    return volumeserial
+    if len(opt) == 0 or len(opt[0].strip()) == 0:
+        return None
+    return opt[0].strip()
 
-# If specific the filesystem can have IO frozen to ensure no further write operations occur while the snapshot is being taken
-def freeze_filesystem(volume_mount):
-    sshclient = prepare_ssh_connection()
-    get_volumemountpoint_command = "sudo /sbin/fsfreeze --freeze" + str(volume_mount)
-    stdin, stdout, stderr = sshclient.exec_command(get_volumemountpoint_command)
-    opt = stdout.readlines()
-    sshclient.close()
-# If specific the filesystem can have IO unforzen to ensure write operations can continue. Only used if the filesystem is frozen first
-def unfreeze_filesystem(volume_mount):
+# A single probe on the host returns its fingerprint and the device , world wide ID and size of every mount holding or below
+# the SAP HANA persistence base paths , however many volumes there are it costs one round trip
+# Each volume mount point is then resolved from that table of mounts
+def get_host_inventory():
+    topology = get_saphana_topology()
+    basepaths = [basepath for basepath in (topology.data_basepath, topology.log_basepath) if basepath is not None]
     sshclient = prepare_ssh_connection()
-    get_volumemountpoint_command = "sudo /sbin/fsfreeze --unfreeze" + str(volume_mount)
-    stdin, stdout, stderr = sshclient.exec_command(get_volumemountpoint_command)
-    opt = stdout.readlines()
+    inventory = probe_host_inventory(sshclient, (), basepaths)
     sshclient.close()
+    return inventory
 
-# This method takes the volume serial number , matches it against a volume on the selected flasharray and then takes a storage snapshot
-# If the volume world wide ID string matches the VMware vendor string , then the vcenter credentials are used to check if vvols are being used
-# VMFS based virtual disks are not supported - only vVols
-def create_flasharray_volume_snapshot(serialnumber,snapshot_suffix):
+# In order to match the volumes presented to the operating system the world wide ID of each mount point is identified
+def get_volume_serialnos(inventory, volume_mounts):
+    serialnumbers = []
+    for volume_mount in volume_mounts:
+        serialnumber = inventory.get_wwid(volume_mount)
+        if serialnumber is None:
+            raise NameError('The world wide ID of the volume mounted at ' + str(volume_mount) + ' could not be found')
+        serialnumbers.append(serialnumber)
+    return serialnumbers
+
+# If specific the filesystems can have IO frozen to ensure no further write operations occur while the snapshot is being taken
+# The thaw of every filesystem is armed before it is frozen and is always carried out , even if the snapshot fails or
+# takes longer than the maximum freeze duration. All filesystems are frozen and thawed together and how long each
+# filesystem was frozen is reported afterwards
+def create_snapshot_with_frozen_filesystems(volume_mounts, create_snapshot):
+    freezes = []
+    if(freezefilesystem == True):
+        freezes = [FilesystemFreeze(prepare_ssh_connection(), volume_mount, maxfreezeduration, hostaddress) \
+            for volume_mount in volume_mounts]
+    with FreezeBarrier(freezes, freezealertthreshold):
+        return create_snapshot()
+
+# This method takes the name of the volume resolved from the data volume mount point and takes a storage snapshot of it on the selected flasharray
+def create_flasharray_volume_snapshot(volname,snapshot_suffix):
     array = flasharray.Client(flasharraydevice, api_token=flasharrayapitoken, username=flasharrayuser, verify_ssl=None)
-    snapserial = None
-    vendor_string = serialnumber[0 : 8]
-    # This is a disk directly attached to the host
-    if(vendor_string == '3624a937'):
-        volumes = array.get_volumes()
-        for key in volumes.items:
-            volname = key.name
-            volserial = str(key.serial).lower()
-            found = volserial.lower() in serialnumber.lower()
-            if found:
-                volsnappost = flasharray.VolumeSnapshotPost(destroyed=None, suffix=snapshot_suffix)
-                snapshot_id = array.post_volume_snapshots(source_names=volname, volume_snapshot=volsnappost)
-                for snap in snapshot_id.items:
-                    return snap.serial
-    elif(vendor_string == '36000c29'):
-        # Then this is a VMware vdisk volume ,need to check if it is vvol based
-        vm_disk_info = None
-        if(vcenteraddress is not None and vcenteruser is not None and vcenterpassword is not None):
-            vcenter_dict = {'address':vcenteraddress,'vc_user':vcenteruser,'vc_pass':vcenterpassword}
-        else:
-            raise NameError('The volume has been detected to be a virtual disk but no vCenter credentials have been supplied to further parse the request')
-        vm_disk_info = vsphere_get_vvol_disk_identifiers(serialnumber,vcenter_dict)
-        if vm_disk_info is not None:
-            volume = array.list_virtual_volume(vm_disk_info.get('backingObjectId'))
-            if(volume.__len__() != 0):
-                for attr in volume:
-                    if(attr.get('key') == 'PURE_VVOL_ID'):
-                        volname = attr.get('name')
-                        vol = array.get_volume(volname)
-                        vvolvolserial = vol.get('serial')
-                        volumes =  array.list_volumes()
-                        for key in volumes:
-                            volname = key.get("name")
-                            volserial = str(key.get("serial")).lower()
-                            found = volserial.lower() in vvolvolserial.lower()
-                            if found:
-                                snapshot_id = array.create_snapshot(volname, suffix=snapshot_suffix)
-                                snapserial = str(snapshot_id.get("serial"))
-                                return snapserial
-    if(snapserial is None):
-         raise NameError('The volume was not found on this array or this is not a supported volume for a data snapshot')
-    
+    volsnappost = flasharray.VolumeSnapshotPost(destroyed=None, suffix=snapshot_suffix)
+    snapshot_id = array.post_volume_snapshots(source_names=volname, volume_snapshot=volsnappost)
+    for snap in snapshot_id.items:
+        return snap.serial
+    raise NameError('The volume was not found on this array or this is not a supported volume for a data snapshot')
+
 # The SAP HANA data snapshot must be prepared before taking a block volume snapshot , this sends the SQL command to the platform to do so. 
 def prepare_saphana_storage_snapshot():
     now = datetime.now()
@@ -246,76 +240,109 @@ def abandon_saphana_storage_snapshot(BackupID, EBID):
 # When using an application consistent data snapshot only the data volume is needed as the process will trigger a savepoint 
 # Recovery will nullify all transaction logs 
 def get_saphana_data_volume_mount():
-    hdbGetHANADataVolumeMount = "SELECT VALUE FROM M_INIFILE_CONTENTS WHERE FILE_NAME = \
-        'global.ini' AND SECTION = 'persistence' AND KEY = 'basepath_datavolumes'  AND VALUE NOT LIKE '$%'"
-    data_volume = execute_saphana_command(hdbGetHANADataVolumeMount, port)
-    instanceid = get_saphana_instanceid()
-    data_volume = data_volume[0].column_values
-    data_volume = str(data_volume[0]).replace("/" + instanceid, "")
-    return data_volume
+    return get_saphana_topology().data_volume_mount()
 
 # This method helps to identify the volume name 
 # To create a block storage snapshot the volume name is used with the Pure Storage RESTFul API
 def get_volume_name(serialno):
     array = flasharray.Client(flasharraydevice, api_token=flasharrayapitoken, username=flasharrayuser, verify_ssl=None)
-    volumes = array.get_volumes()
-    for key in volumes.items:
-        volname = key.name
-        volserial = str(key.serial).lower()
-        found = volserial.lower() in serialno.lower()
-        if found:
-            return volname
+    volname = get_volume_index(array).get_volume_name(serialno)
+    if volname is not None:
+        return volname
     return False
 
-# SAP HANA keeps track of the data and log volumes , this method will query the platform to return the location of the log and data volumes 
-# When using a crash consistent storage snapshot both the data and log volumes are required
-def get_persistence_volumes_location():
-    hdbGetPersistenceVolumesLocation = "SELECT VALUE,KEY FROM M_INIFILE_CONTENTS WHERE FILE_NAME = 'global.ini' \
-        AND SECTION = 'persistence' AND (KEY = 'basepath_datavolumes' OR KEY = 'basepath_logvolumes') \
-        AND VALUE NOT LIKE '$%'"
-    persistenceVolumes = execute_saphana_command(hdbGetPersistenceVolumesLocation, port)
+# This method takes the volume serial number and matches it against a volume on the selected flasharray , returning the volume name and serial number
+# If the volume world wide ID string matches the VMware vendor string , then the vcenter credentials are used to check if vvols are being used
+# VMFS based virtual disks are not supported - only vVols
+def resolve_flasharray_volume(serialNumber, vvol_disks):
+    vendor_string = serialNumber[0 : 8]
+    volname = None
+    volserial = None
+    if(vendor_string == '3624a937'):
+        # This is a direct attached volume 
+        volname = get_volume_name(serialNumber)
+        volserial = normalize_serial(serialNumber)
+    elif(vendor_string == '36000c29'):
+        # Then this is a VMware vdisk volume ,need to check if it is vvol based
+        array = flasharray.Client(flasharraydevice, api_token=flasharrayapitoken, username=flasharrayuser, verify_ssl=None)
+        vm_disk_info = vvol_disks.get(serialNumber)
+        if vm_disk_info is not None:
+            volume = array.list_virtual_volume(vm_disk_info.get('backingObjectId'))
+            if(volume.__len__() != 0):
+                for attr in volume:
+                    if(attr.get('key') == 'PURE_VVOL_ID'):
+                        volname = attr.get('name')
+                        vol = array.get_volume(volname)
+                        vvolvolserial = vol.get('serial')
+                        thisvolname = get_volume_index(array).get_volume_name(vvolvolserial)
+                        if thisvolname is not None:
+                            volname = thisvolname
+                            volserial = normalize_serial(vvolvolserial)
+    if (volname == None or volname == False):
+        raise NameError('The volume was not found on this array or this is not a supported volume for a data snapshot')
+    return volname, volserial
+
+# Every virtual disk serial number is resolved against vCenter together , using one vCenter session and a single inventory pass
+def get_vvol_disks(serialnumbers):
+    vvol_serials = [serialno for serialno in serialnumbers if serialno[0 : 8] == '36000c29']
+    if len(vvol_serials) == 0:
+        return {}
+    if(vcenteraddress is not None and vcenteruser is not None and vcenterpassword is not None):
+        vcenter_dict = {'address':vcenteraddress,'vc_user':vcenteruser,'vc_pass':vcenterpassword}
+    else:
+        raise NameError('The volume has been detected to be a virtual disk but no vCenter credentials have been supplied to further parse the request')
+    return vsphere_get_vvol_disk_identifiers_batch(vvol_serials, vcenter_dict, get_vm_uuid())
+
+# A cached topology is only used if the world wide ID just probed for every mount point is still the one that was recorded
+def cached_volumes_match_inventory(volumes, inventory):
+    for volume in volumes:
+        if inventory.get_wwid(volume.get('mountpoint')) != volume.get('serialnumber'):
+            return False
+    return True
+
+# A cached topology is only used if every volume still exists on the array with the serial number that was recorded
+def volumes_present_on_array(volumes):
+    array = flasharray.Client(flasharraydevice, api_token=flasharrayapitoken, username=flasharrayuser, verify_ssl=None)
+    response = array.get_volumes(names=[volume.get('volumename') for volume in volumes])
+    arrayserials = {}
+    for item in getattr(response, 'items', []):
+        arrayserials[item.name] = normalize_serial(item.serial)
+    for volume in volumes:
+        if arrayserials.get(volume.get('volumename')) != volume.get('volumeserial'):
+            return False
+    return True
+
+# Each mount point is resolved to its world wide ID and FlashArray volume
+# The result is kept in the topology cache so that a later run on an unchanged host can skip discovery
+def resolve_persistence_volumes(mounts):
     instanceid = get_saphana_instanceid()
+    inventory = get_host_inventory()
+    fingerprint = inventory.fingerprint
+    if topology_cache is not None:
+        volumes = topology_cache.load(instanceid, hostaddress, fingerprint, mounts)
+        if volumes is not None:
+            if cached_volumes_match_inventory(volumes, inventory) and volumes_present_on_array(volumes):
+                return volumes
+            topology_cache.invalidate(instanceid, hostaddress)
+    serialnumbers = get_volume_serialnos(inventory, mounts)
+    vvol_disks = get_vvol_disks(serialnumbers)
     volumes = []
-    for item in persistenceVolumes:
-        mount = item.column_values[0]
-        mount = str(mount).replace("/" + instanceid, "")
-        serialNumber = get_volume_serialno(mount)
-        vendor_string = serialNumber[0 : 8]
-        volname = None
-        if(vendor_string == '3624a937'):
-            # This is a direct attached volume 
-            volname = get_volume_name(serialNumber)
-        elif(vendor_string == '36000c29'):
-            # Then this is a VMware vdisk volume ,need to check if it is vvol based
-            vm_disk_info = None
-            array = flasharray.Client(flasharraydevice, api_token=flasharrayapitoken, username=flasharrayuser, verify_ssl=None)
-            if(vcenteraddress is not None and vcenteruser is not None and vcenterpassword is not None):
-                vcenter_dict = {'address':vcenteraddress,'vc_user':vcenteruser,'vc_pass':vcenterpassword}
-            else:
-                raise NameError('The volume has been detected to be a virtual disk but no vCenter credentials have been supplied to further parse the request')
-            vm_disk_info = vsphere_get_vvol_disk_identifiers(serialNumber,vcenter_dict)
-            if vm_disk_info is not None:
-                volume = array.list_virtual_volume(vm_disk_info.get('backingObjectId'))
-                if(volume.__len__() != 0):
-                    for attr in volume:
-                        if(attr.get('key') == 'PURE_VVOL_ID'):
-                            volname = attr.get('name')
-                            vol = array.get_volume(volname)
-                            vvolvolserial = vol.get('serial')
-                            volumes_toparse =  array.list_volumes()
-                            for key in volumes_toparse:
-                                thisvolname = key.get("name")
-                                thisvolserial = str(key.get("serial")).lower()
-                                found = thisvolserial.lower() in vvolvolserial.lower()
-                                if found:
-                                    volname = thisvolname
-        if (volname == None):
-            raise NameError('The volume was not found on this array or this is not a supported volume for a data snapshot')
-        else:
-            volumedata = {'mountpoint': mount, 'serialnumber': serialNumber, 'volumename' : volname}
-            volumes.append(volumedata)
+    for mount, serialNumber in zip(mounts, serialnumbers):
+        volname, volserial = resolve_flasharray_volume(serialNumber, vvol_disks)
+        volumedata = {'mountpoint': mount, 'serialnumber': serialNumber, 'volumename' : volname, \
+            'volumeserial' : volserial}
+        volumes.append(volumedata)
+    if topology_cache is not None:
+        topology_cache.store(instanceid, hostaddress, fingerprint, volumes)
     return volumes
 
+# SAP HANA keeps track of the data and log volumes , this method will query the platform to return the location of the log and data volumes 
+# When using a crash consistent storage snapshot both the data and log volumes are required
+def get_persistence_volumes_location():
+    topology = get_saphana_topology()
+    mounts = [mount for mount in (topology.data_volume_mount(), topology.log_volume_mount()) if mount is not None]
+    return resolve_persistence_volumes(mounts)
+
 # If using crash consistency then the volumes are added to a protection group and a protection group snap is created
 def create_protection_group_snap(volumes):
     instanceid = get_saphana_instanceid()
@@ -334,17 +361,15 @@ def create_protection_group_snap(volumes):
 
 # This is the equivalent of the "Main" method where execution is run
 try:
+    saphana_backup_id = None
     check_pythonversion()
     if(crashconsistent == False):
         data_volume = get_saphana_data_volume_mount()
+        data_volume_info = resolve_persistence_volumes([data_volume])[0]
         saphana_backup_id = prepare_saphana_storage_snapshot()
-        if(freezefilesystem == True):
-            freeze_filesystem(data_volume)
-        volume_snapshot_id = create_flasharray_volume_snapshot(get_volume_serialno(data_volume), \
-             "SAPHANA-" + str(saphana_backup_id))
+        volume_snapshot_id = create_snapshot_with_frozen_filesystems([data_volume], \
+            lambda: create_flasharray_volume_snapshot(data_volume_info.get('volumename'), "SAPHANA-" + str(saphana_backup_id)))
         print("Volume Snapshot serial number : " + str(volume_snapshot_id))
-        if(freezefilesystem == True):
-            unfreeze_filesystem(data_volume)
         if saphana_backup_id is not None and volume_snapshot_id is not None:
             print("Confirming storage snapshot with SAP HANA Backup ID : " + str(saphana_backup_id))
             confirm_saphana_storage_snapshot(saphana_backup_id, volume_snapshot_id)
@@ -353,13 +378,8 @@ try:
             abandon_saphana_storage_snapshot(saphana_backup_id, "no_value")
     else:
        formattedvolumes =  get_persistence_volumes_location()
-       for volume in formattedvolumes:
-            if(freezefilesystem == True):
-                freeze_filesystem(volume.get('mountpoint'))
-       snapname  = create_protection_group_snap(formattedvolumes)
-       for volume in formattedvolumes:
-            if(freezefilesystem == True):
-                unfreeze_filesystem(volume.get('mountpoint'))
+       snapname  = create_snapshot_with_frozen_filesystems([volume.get('mountpoint') for volume in formattedvolumes], \
+            lambda: create_protection_group_snap(formattedvolumes))
        print ("Crash consistent storage snapshot created")
 except Exception as e:
     print(e)
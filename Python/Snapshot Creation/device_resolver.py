@@ -0,0 +1,167 @@
+##################################################################################################
+#                                                                                                #
+#                  Pure Storage Inc. (2024) SAP HANA mount device resolver module                #
+#     Resolves mount points to their block device and world wide ID from /proc and /sys          #
+#                                                                                                #
+##################################################################################################
+
+import json
+import shlex
+from typing import Dict, List, NamedTuple
+
+# The probe is run on the host with python3 and is given the paths to resolve and the SAP HANA persistence base
+# paths as a single JSON argument. For each path the filesystem mounted on it ( or the only filesystem mounted
+# below it ) or otherwise the filesystem holding it is found in /proc/self/mountinfo , its device number is
+# followed through /sys/dev/block to the block device and the world wide ID is read from the device mapper uuid
+# or the SCSI wwid in sysfs. Devices stacked on other device mapper devices ( for example LVM ) are followed down
+# their slaves to the multipath device. Every filesystem at or below a base path , and the filesystem holding the
+# base path unless that is the root filesystem , is described the same way.
+# The kernel boot id and a hash of the mount table are returned with it so that the whole inventory of a host
+# is printed as a single JSON object from a single command
+HOST_INVENTORY_PROBE = r'''
+import hashlib, json, os, re, sys
+
+def read(path):
+    try:
+        with open(path) as sysfile:
+            return sysfile.read().strip()
+    except (IOError, OSError):
+        return None
+
+def unescape(path):
+    return re.sub(r'\\([0-7]{3})', lambda match: chr(int(match.group(1), 8)), path)
+
+def slaves(name):
+    try:
+        return sorted(os.listdir('/sys/class/block/' + name + '/slaves'))
+    except (IOError, OSError):
+        return []
+
+def wwid(name, depth=0):
+    uuid = read('/sys/class/block/' + name + '/dm/uuid')
+    if uuid is not None:
+        if uuid.startswith('mpath-'):
+            return uuid[len('mpath-'):]
+        if depth < 8:
+            for slave in slaves(name):
+                slave_wwid = wwid(slave, depth + 1)
+                if slave_wwid is not None:
+                    return slave_wwid
+        return None
+    if os.path.exists('/sys/class/block/' + name + '/partition'):
+        name = os.path.basename(os.path.dirname(os.path.realpath('/sys/class/block/' + name)))
+    scsi_wwid = read('/sys/class/block/' + name + '/device/wwid')
+    if scsi_wwid is not None and scsi_wwid.startswith('naa.'):
+        return '3' + scsi_wwid[len('naa.'):].lower()
+    return scsi_wwid
+
+def below(path):
+    return [mount for mount in mounts if mount[0] == path or mount[0].startswith(path.rstrip('/') + '/')]
+
+def holding(path):
+    found = [mount for mount in mounts if path == mount[0] or path.startswith(mount[0].rstrip('/') + '/')]
+    return sorted(found, key=lambda mount: len(mount[0]))
+
+def describe(mount):
+    mountpoint, devno = mount
+    if not os.path.exists('/sys/dev/block/' + devno):
+        return None
+    name = os.path.basename(os.path.realpath('/sys/dev/block/' + devno))
+    sectors = read('/sys/class/block/' + name + '/size')
+    return {'mountpoint': mountpoint, 'device': '/dev/' + name,
+            'dm_name': read('/sys/class/block/' + name + '/dm/name'), 'wwid': wwid(name),
+            'size': int(sectors) * 512 if sectors is not None and sectors.isdigit() else None,
+            'slaves': slaves(name)}
+
+request = json.loads(sys.argv[1])
+with open('/proc/self/mountinfo', 'rb') as mountinfo:
+    mountinfo_content = mountinfo.read()
+mounts = []
+for line in mountinfo_content.decode('utf-8', 'replace').splitlines():
+    fields = line.split()
+    mounts.append((unescape(fields[4]), fields[2]))
+
+devices = {}
+for path in request.get('paths', []):
+    mounted = below(path)
+    if len(set(mount[0] for mount in mounted)) == 1:
+        device = describe(mounted[-1])
+    elif holding(path):
+        device = describe(holding(path)[-1])
+    else:
+        device = None
+    if device is not None:
+        devices[path] = device
+
+persistence_mounts = {}
+for basepath in request.get('basepaths', []):
+    for mount in holding(basepath)[-1:] + below(basepath):
+        if mount[0] == '/':
+            continue
+        device = describe(mount)
+        if device is not None:
+            persistence_mounts[mount[0]] = device
+
+print(json.dumps({'fingerprint': {'boot_id': read('/proc/sys/kernel/random/boot_id'),
+                                  'mountinfo_hash': hashlib.sha256(mountinfo_content).hexdigest()},
+                  'devices': devices,
+                  'mounts': [persistence_mounts[mountpoint] for mountpoint in sorted(persistence_mounts)]}))
+'''
+
+# The fingerprint is the kernel boot id and mount table hash the topology cache is keyed on , devices holds the
+# description of every requested path and mounts every filesystem found at or below the persistence base paths
+class HostInventory(NamedTuple):
+    fingerprint: Dict[str, str]
+    devices: Dict[str, dict]
+    mounts: List[dict]
+
+    # A path is resolved against the mounts table in the same way as the probe resolves a requested path , to the
+    # filesystem mounted on it , otherwise the only filesystem mounted below it or the filesystem holding it
+    def get_mount(self, path):
+        path = str(path).rstrip('/')
+        for mount in self.mounts:
+            if mount.get('mountpoint') == path:
+                return mount
+        mounted = [mount for mount in self.mounts if mount.get('mountpoint').startswith(path + '/')]
+        if len(mounted) == 1:
+            return mounted[0]
+        holding = [mount for mount in self.mounts if path.startswith(mount.get('mountpoint') + '/')]
+        if len(holding) > 0:
+            return max(holding, key=lambda mount: len(mount.get('mountpoint')))
+        return None
+
+    def get_device(self, path):
+        device = self.devices.get(str(path))
+        if device is None:
+            device = self.get_mount(path)
+        return device
+
+    def get_wwid(self, path):
+        device = self.get_device(path)
+        if device is None:
+            return None
+        return device.get('wwid')
+
+# This method runs the probe through the supplied connection , which may run the command over SSH or locally ,
+# so that however many volumes a host has its inventory costs a single round trip
+def probe_host_inventory(connection, paths, basepaths=()):
+    request = {'paths': [str(path) for path in paths], 'basepaths': [str(path) for path in basepaths]}
+    probe_command = "python3 -c " + shlex.quote(HOST_INVENTORY_PROBE) + " " + shlex.quote(json.dumps(request))
+    stdin, stdout, stderr = connection.exec_command(probe_command)
+    opt = stdout.readlines()
+    try:
+        inventory = json.loads("".join(opt))
+    except ValueError:
+        raise NameError('The storage inventory of ' + str(getattr(connection, 'host', 'the host')) + \
+            ' could not be read : ' + "".join(stderr.readlines()))
+    fingerprint = inventory.get('fingerprint') or {}
+    if fingerprint.get('boot_id') is None:
+        fingerprint = None
+    return HostInventory(fingerprint, inventory.get('devices') or {}, inventory.get('mounts') or [])
+
+# This method resolves every path in a single command on the host. The device , device mapper name , world wide ID ,
+# size in bytes and slaves are returned keyed by path , paths that are not on a block device are left out
+def resolve_mount_devices(connection, paths):
+    if len(paths) == 0:
+        return {}
+    return probe_host_inventory(connection, paths).devices
@@ -0,0 +1,231 @@
+##################################################################################################
+#                                                                                                #
+#                  Pure Storage Inc. (2024) SAP HANA filesystem freeze module                    #
+#     Freezes a filesystem for a storage snapshot with a thaw that is always carried out         #
+#                                                                                                #
+##################################################################################################
+
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+DEFAULT_MAX_FREEZE_SECONDS = 30
+
+# Before the filesystem is frozen the thaw command is started on its own channel , where it waits for a start line
+# on its standard input. The start line is sent once the freeze has been acknowledged , from then on the thaw runs as
+# soon as a second line is sent , when the channel is closed because the script or its connection has gone away , or
+# when the maximum freeze duration has passed on the host itself. Each line is read by the shell builtin read , which
+# never consumes more than the one line it is waiting for.
+# A watchdog thread in the script sends the line once the maximum freeze duration has passed , so the filesystem
+# is thawed even if the snapshot request never returns. If the armed thaw cannot be confirmed the filesystem is
+# unfrozen directly on a new channel instead.
+# The time between the freeze and the thaw being acknowledged is recorded as the freeze duration
+class FilesystemFreeze:
+
+    def __init__(self, connection, mountpoint, max_duration=DEFAULT_MAX_FREEZE_SECONDS, host=None):
+        self.connection = connection
+        self.mountpoint = str(mountpoint)
+        self.max_duration = max_duration
+        self.host = host if host is not None else getattr(connection, 'host', None)
+        self.duration = None
+        self.freeze_latency = None
+        self.expired = False
+        self._freeze_sent = False
+        self._frozen_at = None
+        self._thawed = False
+        self._thaw_stdin = None
+        self._thaw_stdout = None
+        self._watchdog = None
+        self._lock = threading.Lock()
+
+    # The thaw is armed first so that it is already in place when the freeze takes effect
+    def arm(self):
+        thaw_command = "read -r start ; timeout " + str(int(self.max_duration) + 1) + " sh -c 'read -r line' ; " + \
+            "sudo /sbin/fsfreeze --unfreeze " + self.mountpoint + " && echo thawed"
+        self._thaw_stdin, self._thaw_stdout, stderr = self.connection.exec_command(thaw_command)
+
+    def freeze(self):
+        if self._thaw_stdin is None:
+            self.arm()
+        freeze_command = "sudo /sbin/fsfreeze --freeze " + self.mountpoint + " && echo frozen"
+        start = time.monotonic()
+        self._freeze_sent = True
+        try:
+            stdin, stdout, stderr = self.connection.exec_command(freeze_command)
+            opt = stdout.readlines()
+            error = "".join(stderr.readlines())
+        except Exception as e:
+            opt = []
+            error = str(e)
+        if len(opt) == 0 or opt[-1].strip() != "frozen":
+            self.thaw()
+            raise NameError('The filesystem ' + self.mountpoint + ' could not be frozen : ' + error)
+        self._frozen_at = time.monotonic()
+        self.freeze_latency = self._frozen_at - start
+        # The maximum freeze duration on the host only starts counting now that the freeze has been acknowledged
+        try:
+            self._thaw_stdin.write("start\n")
+            self._thaw_stdin.flush()
+        except Exception:
+            self.thaw()
+            raise NameError('The thaw of the filesystem ' + self.mountpoint + ' could not be started')
+        self._watchdog = threading.Timer(self.max_duration, self._expire)
+        self._watchdog.daemon = True
+        self._watchdog.start()
+
+    # A failure here is not lost , the filesystem is not marked as thawed and the next thaw tries again
+    def _expire(self):
+        self.expired = True
+        try:
+            self.thaw()
+        except Exception:
+            pass
+
+    def _release_armed_thaw(self):
+        thaw_stdin, thaw_stdout = self._thaw_stdin, self._thaw_stdout
+        self._thaw_stdin = None
+        self._thaw_stdout = None
+        if thaw_stdin is None:
+            return False
+        try:
+            thaw_stdin.write("\n")
+            thaw_stdin.flush()
+        except Exception:
+            pass
+        try:
+            thaw_stdin.close()
+            opt = thaw_stdout.readlines()
+        except Exception:
+            return False
+        return len(opt) > 0 and opt[-1].strip() == "thawed"
+
+    # The kernel rejects the unfreeze of a filesystem that is not frozen with Invalid argument , in that case the armed
+    # thaw has already run on the host , for example because it saw its channel close
+    def _unfreeze(self):
+        unfreeze_command = "error=$(LC_ALL=C sudo /sbin/fsfreeze --unfreeze " + self.mountpoint + " 2>&1) && echo thawed || " + \
+            "{ echo \"$error\" | grep -q 'Invalid argument' && echo thawed ; }"
+        try:
+            stdin, stdout, stderr = self.connection.exec_command(unfreeze_command)
+            opt = stdout.readlines()
+        except Exception:
+            return False
+        return len(opt) > 0 and opt[-1].strip() == "thawed"
+
+    # The thaw can be called any number of times and from any thread , the filesystem is only thawed once
+    # If the freeze was never acknowledged there is nothing to confirm , the freeze failure is reported instead
+    def thaw(self):
+        with self._lock:
+            if self._thawed or (self._thaw_stdin is None and not self._freeze_sent):
+                return
+            if self._watchdog is not None:
+                self._watchdog.cancel()
+            thawed = self._release_armed_thaw()
+            if not thawed and self._freeze_sent:
+                thawed = self._unfreeze()
+            if self._frozen_at is not None:
+                self.duration = time.monotonic() - self._frozen_at
+            if not thawed and self._frozen_at is not None:
+                raise NameError('The thaw of the filesystem ' + self.mountpoint + ' could not be confirmed')
+            self._thawed = True
+
+    def location(self):
+        return self.mountpoint if self.host is None else self.mountpoint + " on " + str(self.host)
+
+    def describe(self):
+        if self.duration is None:
+            return "Filesystem " + self.location() + " was not frozen"
+        return "Filesystem " + self.location() + " frozen for " + "{:.3f}".format(self.duration) + " seconds"
+
+# If the watchdog had to thaw any filesystem the snapshot was not taken while every filesystem was frozen
+def check_freeze_expiry(freezes):
+    for freeze in freezes:
+        if freeze.expired:
+            raise NameError('The filesystem ' + freeze.mountpoint + ' was thawed by the watchdog after ' + \
+                str(freeze.max_duration) + ' seconds before the snapshot completed')
+
+# Every freeze is printed with its duration , freezes longer than the alert threshold are reported with a warning
+def report_freeze_durations(freezes, alert_threshold=None):
+    for freeze in freezes:
+        print(freeze.describe())
+        if alert_threshold is not None and freeze.duration is not None and freeze.duration > alert_threshold:
+            print("WARNING : " + freeze.describe() + " , longer than the alert threshold of " + \
+                str(alert_threshold) + " seconds")
+
+# The barrier freezes every filesystem on every host at the same time. Each filesystem gets its own worker , which
+# arms its thaw and then waits until every other thaw is armed before issuing its freeze , so all freezes go out
+# together and the snapshot is only taken once every freeze has been acknowledged. The thaws are also sent together ,
+# so how long a filesystem stays frozen does not grow with the number of filesystems.
+# If any filesystem cannot be armed , or not every thaw is armed within the timeout , none are frozen. If any cannot
+# be frozen all are thawed again. Unless given the timeout is the longest maximum freeze duration of the filesystems
+class FreezeBarrier:
+
+    def __init__(self, freezes, alert_threshold=None, timeout=None):
+        self.freezes = list(freezes)
+        self.alert_threshold = alert_threshold
+        if timeout is None:
+            timeout = max([freeze.max_duration for freeze in self.freezes] or [DEFAULT_MAX_FREEZE_SECONDS])
+        self.timeout = timeout
+
+    def _run_all(self, operation):
+        failures = []
+        if len(self.freezes) == 0:
+            return failures
+        with ThreadPoolExecutor(max_workers=len(self.freezes)) as executor:
+            futures = [executor.submit(operation, freeze) for freeze in self.freezes]
+            for freeze, future in zip(self.freezes, futures):
+                try:
+                    future.result()
+                except Exception as e:
+                    failures.append((freeze, e))
+        return failures
+
+    def _describe_failures(self, failures):
+        errors = []
+        for freeze, e in failures:
+            if isinstance(e, threading.BrokenBarrierError):
+                errors.append('Filesystem ' + freeze.location() + ' was not frozen as not every thaw was armed within ' + \
+                    str(self.timeout) + ' seconds')
+            else:
+                errors.append('Filesystem ' + freeze.location() + ' : ' + str(e))
+        return errors
+
+    # A barrier broken because an arm failed only needs that failure reported , a barrier broken by its timeout
+    # is a failure of its own
+    def freeze_all(self):
+        barrier = threading.Barrier(len(self.freezes)) if len(self.freezes) > 0 else None
+        arm_failures = []
+
+        def arm_and_freeze(freeze):
+            try:
+                freeze.arm()
+            except Exception:
+                arm_failures.append(freeze)
+                barrier.abort()
+                raise
+            barrier.wait(self.timeout)
+            freeze.freeze()
+
+        failures = self._run_all(arm_and_freeze)
+        if len(arm_failures) > 0:
+            failures = [(freeze, e) for freeze, e in failures if not isinstance(e, threading.BrokenBarrierError)]
+        if len(failures) > 0:
+            errors = self._describe_failures(failures)
+            errors.extend(self._describe_failures(self._run_all(lambda freeze: freeze.thaw())))
+            raise NameError(" , ".join(errors))
+
+    def thaw_all(self):
+        failures = self._run_all(lambda freeze: freeze.thaw())
+        if len(failures) > 0:
+            raise NameError(" , ".join(self._describe_failures(failures)))
+
+    def __enter__(self):
+        self.freeze_all()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        try:
+            self.thaw_all()
+        finally:
+            report_freeze_durations(self.freezes, self.alert_threshold)
+        if exc_type is None:
+            check_freeze_expiry(self.freezes)
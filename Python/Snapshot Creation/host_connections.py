@@ -0,0 +1,192 @@
+##################################################################################################
+#                                                                                                #
+#                  Pure Storage Inc. (2024) SAP HANA host connection helper module               #
+#     Keeps a single SSH transport open per host and runs every command on a new channel         #
+#          Commands for the local host and user are run directly without SSH                     #
+#                                                                                                #
+##################################################################################################
+
+import atexit
+import getpass
+import ipaddress
+import socket
+import subprocess
+import threading
+import paramiko
+from functools import lru_cache
+
+# This method checks whether a host address refers to the machine the script is running on , either by name or by
+# resolving to a loopback or local address. Any failure to resolve is treated as a remote host
+@lru_cache(maxsize=None)
+def is_local_host(host):
+    host = str(host).strip().lower()
+    if host in ('localhost', socket.gethostname().lower(), socket.getfqdn().lower()):
+        return True
+    try:
+        host_addresses = set(info[4][0] for info in socket.getaddrinfo(host, None))
+    except (socket.gaierror, UnicodeError):
+        return False
+    for address in host_addresses:
+        if ipaddress.ip_address(address.split('%')[0]).is_loopback:
+            return True
+    try:
+        local_addresses = set(info[4][0] for info in socket.getaddrinfo(socket.gethostname(), None))
+    except (socket.gaierror, UnicodeError):
+        return False
+    return len(host_addresses & local_addresses) > 0
+
+# The pool holds one connected SSHClient per host and user. paramiko opens a new channel on the
+# existing transport for every exec_command , so only the first command to a host pays for the
+# key exchange and authentication. Connections are closed when the process exits
+# Commands for the local host are only run directly when they would run as the same user over SSH , a different
+# user ( for example <sid>adm ) still logs in over SSH
+class SSHConnectionPool:
+
+    def __init__(self, port=22, allow_local=True):
+        self.port = port
+        self.allow_local = allow_local
+        self._clients = {}
+        self._locks = {}
+        self._lock = threading.Lock()
+        atexit.register(self.close_all)
+
+    def _host_lock(self, key):
+        with self._lock:
+            return self._locks.setdefault(key, threading.Lock())
+
+    def _connect(self, host, username, password):
+        sshclient = paramiko.SSHClient()
+        sshclient.set_missing_host_key_policy(paramiko.AutoAddPolicy())
+        sshclient.connect(
+            host,
+            port=self.port,
+            username=username,
+            password=password
+        )
+        return sshclient
+
+    # An existing client is only handed out while its transport is still active , otherwise a new one is connected
+    def get_client(self, host, username, password):
+        key = (host, username)
+        with self._host_lock(key):
+            sshclient = self._clients.get(key)
+            if sshclient is not None:
+                transport = sshclient.get_transport()
+                if transport is not None and transport.is_active():
+                    return sshclient
+                sshclient.close()
+            sshclient = self._connect(host, username, password)
+            self._clients[key] = sshclient
+            return sshclient
+
+    # If the channel cannot be opened the connection is discarded and the command is retried once on a new connection
+    def exec_command(self, host, username, password, command):
+        sshclient = self.get_client(host, username, password)
+        try:
+            return sshclient.exec_command(command)
+        except (paramiko.SSHException, EOFError, OSError):
+            self.close(host, username)
+            sshclient = self.get_client(host, username, password)
+            return sshclient.exec_command(command)
+
+    def connection(self, host, username, password):
+        if self.allow_local and username == getpass.getuser() and is_local_host(host):
+            return LocalConnection(host)
+        return PooledSSHConnection(self, host, username, password)
+
+    def close(self, host, username):
+        key = (host, username)
+        with self._host_lock(key):
+            sshclient = self._clients.pop(key, None)
+            if sshclient is not None:
+                sshclient.close()
+
+    def close_all(self):
+        for host, username in list(self._clients):
+            self.close(host, username)
+
+# This is the object handed to the scripts in place of an SSHClient. Commands run over the pooled
+# transport and close only releases the handle , the transport itself stays open for the next command
+class PooledSSHConnection:
+
+    def __init__(self, pool, host, username, password):
+        self._pool = pool
+        self.host = host
+        self._username = username
+        self._password = password
+
+    def exec_command(self, command):
+        return self._pool.exec_command(self.host, self._username, self._password, command)
+
+    def close(self):
+        pass
+
+# The standard output of a local command is read by the caller , once it has been read to the end the process is
+# waited on so that it does not remain behind as a zombie
+class LocalCommandOutput:
+
+    def __init__(self, process, stream):
+        self._process = process
+        self._stream = stream
+
+    def _finish(self):
+        self._stream.close()
+        self._process.wait()
+
+    def read(self):
+        output = self._stream.read()
+        self._finish()
+        return output
+
+    def readline(self):
+        line = self._stream.readline()
+        if line == "":
+            self._finish()
+        return line
+
+    def readlines(self):
+        lines = self._stream.readlines()
+        self._finish()
+        return lines
+
+    def __iter__(self):
+        return iter(self.readline, "")
+
+# The error output of a local command is read by a thread of its own while the command runs , a command writing a
+# lot of error output can then not block on a full pipe while the caller is still reading its standard output
+class LocalCommandError:
+
+    def __init__(self, stream):
+        self._lines = []
+        self._thread = threading.Thread(target=self._drain, args=(stream,), daemon=True)
+        self._thread.start()
+
+    def _drain(self, stream):
+        try:
+            for line in stream:
+                self._lines.append(line)
+        finally:
+            stream.close()
+
+    def read(self):
+        return "".join(self.readlines())
+
+    def readlines(self):
+        self._thread.join()
+        return list(self._lines)
+
+# This is handed to the scripts in place of an SSHClient when the host is the local machine. Each command is run
+# by the shell in a subprocess and , as with an SSH channel , is started without waiting for it to finish. Its
+# standard input , output and error are returned as file objects in the same form as exec_command
+class LocalConnection:
+
+    def __init__(self, host='localhost'):
+        self.host = host
+
+    def exec_command(self, command):
+        process = subprocess.Popen(command, shell=True, stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+                                   stderr=subprocess.PIPE, universal_newlines=True)
+        return process.stdin, LocalCommandOutput(process, process.stdout), LocalCommandError(process.stderr)
+
+    def close(self):
+        pass
@@ -8,12 +8,19 @@ given release of Purity running on the FlashArray.
 
 import json
 import requests
+import threading
 
+from concurrent.futures import ThreadPoolExecutor
+from http.cookiejar import DefaultCookiePolicy
+from requests.adapters import HTTPAdapter
 from distutils.version import LooseVersion
 
 # The current version of this library.
 VERSION = "1.19.0"
 
+# Number of elements requested per call by the iterating list methods.
+DEFAULT_PAGE_SIZE = 500
+
 
 class FlashArray(object):
 
@@ -40,6 +47,9 @@ class FlashArray(object):
     :param request_kwargs: Keyword arguments that we will pass into the the call
                            to requests.request.
     :type request_kwargs: dict, optional
+    :param pool_size: Maximum number of keep-alive connections to hold open
+                      to the target array.
+    :type pool_size: int, optional
     :raises: :class:`PureError`
         - If the target array cannot be found.
         - If the target array does not support any of the REST versions used by
@@ -70,6 +80,15 @@ class FlashArray(object):
         (e.g. request_kwargs={"verify": "path/to/ca_bundle"})
         You should consider these options deprecated, though we will continue
         to support them for backward compatibility for the foreseeable future.
+    .. note::
+        All requests are sent through a single pooled requests.Session so
+        that repeated calls reuse established TCP and TLS connections. The
+        pool is closed by invalidate_cookie.
+    .. note::
+        A FlashArray object can be shared between threads. The session
+        cookie is only read and updated under a lock and a REST session
+        that has expired is re-established by one thread at a time. Set
+        pool_size to at least the number of threads using the object.
     """
 
     supported_rest_versions = [
@@ -96,7 +115,7 @@ class FlashArray(object):
 
     def __init__(self, target, username=None, password=None, api_token=None,
                  rest_version=None, verify_https=False, ssl_cert=None,
-                 user_agent=None, request_kwargs=None):
+                 user_agent=None, request_kwargs=None, pool_size=4):
 
         if not api_token and not (username and password):
             raise ValueError(
@@ -106,8 +125,13 @@ class FlashArray(object):
                 "Specify only API token or both username and password.")
 
         self._cookies = {}
+        self._cookie_lock = threading.Lock()
+        self._session_lock = threading.Lock()
         self._target = target
 
+        self._pool_size = pool_size
+        self._session = self._create_http_session()
+
         self._renegotiate_rest_version = False if rest_version else True
 
         self._request_kwargs = dict(request_kwargs or {})
@@ -128,6 +152,16 @@ class FlashArray(object):
         self._api_token = (api_token or self._obtain_api_token(username, password))
         self._start_session()
 
+    def _create_http_session(self):
+        """Return a requests.Session with a keep-alive pool for the target."""
+        session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=self._pool_size)
+        session.mount("https://", adapter)
+        # Session cookies are tracked explicitly in self._cookies, so the
+        # session's own cookie jar must never retain them.
+        session.cookies.set_policy(DefaultCookiePolicy(allowed_domains=[]))
+        return session
+
     def _format_path(self, path):
         return "https://{0}/api/{1}/{2}".format(
                 self._target, self._rest_version, path)
@@ -144,9 +178,11 @@ class FlashArray(object):
             headers['User-Agent'] = self._user_agent
 
         body = json.dumps(data).encode("utf-8")
+        with self._cookie_lock:
+            cookies = dict(self._cookies)
         try:
-            response = requests.request(method, url, data=body, headers=headers,
-                                        cookies=self._cookies, **self._request_kwargs)
+            response = self._session.request(method, url, data=body, headers=headers,
+                                             cookies=cookies, **self._request_kwargs)
         except requests.exceptions.RequestException as err:
             # error outside scope of HTTP status codes
             # e.g. unable to resolve domain name
@@ -157,10 +193,7 @@ class FlashArray(object):
 
         if response.status_code == 200:
             if "application/json" in response.headers.get("Content-Type", ""):
-                if response.cookies:
-                    self._cookies.update(response.cookies)
-                else:
-                    self._cookies.clear()
+                self._update_cookies(cookies, response.cookies)
                 content = response.json()
                 if isinstance(content, list):
                     content = ResponseList(content)
@@ -170,7 +203,7 @@ class FlashArray(object):
                 return content
             raise PureError("Response not in JSON: " + response.text)
         elif response.status_code == 401 and reestablish_session:
-            self._start_session()
+            self._restart_session(cookies)
             return self._request(method, path, data, False)
         elif response.status_code == 450 and self._renegotiate_rest_version:
             # Purity REST API version is incompatible.
@@ -233,6 +266,28 @@ class FlashArray(object):
         self._request("POST", "auth/session", {"api_token": self._api_token},
                       reestablish_session=False)
 
+    def _update_cookies(self, sent_cookies, received_cookies):
+        """Record the session cookie returned with a response.
+        The cookies are only cleared if no other thread has replaced the
+        ones that were sent with the request in the meantime.
+        """
+        with self._cookie_lock:
+            if received_cookies:
+                self._cookies.update(received_cookies)
+            elif self._cookies == sent_cookies:
+                self._cookies.clear()
+
+    def _restart_session(self, sent_cookies):
+        """Start a new REST API session after a request was rejected.
+        If another thread has already started a new session since the
+        request was sent, that session is used instead.
+        """
+        with self._session_lock:
+            with self._cookie_lock:
+                current_cookies = dict(self._cookies)
+            if current_cookies == sent_cookies:
+                self._start_session()
+
     def get_rest_version(self):
         """Get the REST API version being used by this object.
         :returns: The REST API version.
@@ -245,9 +300,13 @@ class FlashArray(object):
         .. note::
             Calling any other methods again creates a new cookie. This method
             is intended to be called when the FlashArray object is no longer
-            needed.
+            needed. The pooled HTTP connections to the array are closed as
+            well and are reopened on demand.
         """
-        self._request("DELETE", "auth/session")
+        try:
+            self._request("DELETE", "auth/session")
+        finally:
+            self._session.close()
 
     #
     # Array management methods
@@ -647,6 +706,99 @@ class FlashArray(object):
         """
         return self._request("GET", "volume?tags=true&filter=value='" + tag + "'", kwargs)
 
+    def _list_filtered_volumes(self, volume_filter, fields=None, **kwargs):
+        """Return the volumes matching a filter, reduced to the given fields.
+        The array applies the filter. REST 1.x has no field selection, so the
+        full volume dictionaries are received and only trimmed afterwards.
+        """
+        volumes = self.list_volumes(filter=volume_filter, **kwargs)
+        if not fields:
+            return volumes
+        projected = ResponseList(
+            dict((field, volume.get(field)) for field in fields)
+            for volume in volumes)
+        projected.headers = volumes.headers
+        return projected
+
+    def list_volumes_by_serial(self, serial, fields=None, **kwargs):
+        """Return a list of dictionaries describing the volume with a serial.
+        :param serial: Serial number of the volume, in either case.
+        :type serial: str
+        :param fields: Names of the attributes to keep for each volume.
+        :type fields: list, optional
+        :param \*\*kwargs: See the REST API Guide on your array for the
+                           documentation on the request:
+                           **GET volume**
+        :type \*\*kwargs: optional
+        :returns: A list of dictionaries describing the matching volume.
+        :rtype: ResponseList
+        .. note::
+            The array applies the filter, only matching volumes are returned.
+            REST 1.x has no field selection, fields only trims the
+            dictionaries after they are received.
+        """
+        return self._list_filtered_volumes(
+            "serial='{0}'".format(str(serial).upper()), fields, **kwargs)
+
+    def get_volume_by_serial(self, serial, fields=None, **kwargs):
+        """Return a dictionary describing the volume with a serial.
+        :param serial: Serial number of the volume, in either case.
+        :type serial: str
+        :param fields: Names of the attributes to keep.
+        :type fields: list, optional
+        :returns: A dictionary describing the volume, or None if no volume
+                  has the serial number.
+        :rtype: ResponseDict
+        .. note::
+            See :meth:`list_volumes_by_serial`.
+        """
+        volumes = self.list_volumes_by_serial(serial, fields, **kwargs)
+        if not volumes:
+            return None
+        volume = ResponseDict(volumes[0])
+        volume.headers = volumes.headers
+        return volume
+
+    def list_volumes_by_prefix(self, prefix, fields=None, **kwargs):
+        """Return a list of dictionaries describing volumes with a name prefix.
+        :param prefix: Leading part of the volume names.
+        :type prefix: str
+        :param fields: Names of the attributes to keep for each volume.
+        :type fields: list, optional
+        :param \*\*kwargs: See the REST API Guide on your array for the
+                           documentation on the request:
+                           **GET volume**
+        :type \*\*kwargs: optional
+        :returns: A list of dictionaries describing the matching volumes.
+        :rtype: ResponseList
+        .. note::
+            The array applies the filter, only matching volumes are returned.
+            REST 1.x has no field selection, fields only trims the
+            dictionaries after they are received.
+        """
+        return self._list_filtered_volumes(
+            "name='{0}*'".format(prefix), fields, **kwargs)
+
+    def list_snapshots_by_suffix(self, suffix, fields=None, **kwargs):
+        """Return a list of dictionaries describing snapshots with a suffix.
+        :param suffix: Snapshot suffix, the part of the name after the dot.
+        :type suffix: str
+        :param fields: Names of the attributes to keep for each snapshot.
+        :type fields: list, optional
+        :param \*\*kwargs: See the REST API Guide on your array for the
+                           documentation on the request:
+                           **GET volume**
+        :type \*\*kwargs: optional
+        :returns: A list of dictionaries describing the matching snapshots.
+        :rtype: ResponseList
+        .. note::
+            The array applies the filter, only matching snapshots are
+            returned. REST 1.x has no field selection, fields only trims the
+            dictionaries after they are received.
+        """
+        return self._list_filtered_volumes(
+            "name='*.{0}'".format(suffix), fields, snap=True, **kwargs)
+
     def rename_volume(self, volume, name):
         """Rename a volume.
         :param volume: Name of the volume to be renamed.
@@ -3249,6 +3401,116 @@ class FlashArray(object):
 
         return page_generator()
 
+    def iter_pages(self, function, page_size=DEFAULT_PAGE_SIZE,
+                   prefetch=True, **kwargs):
+        """Return an iterator over the pages of a REST list operation.
+        :param function: FlashArray function that accepts limit as an argument.
+        :param page_size: Number of elements to retrieve per call.
+        :type page_size: int, optional
+        :param prefetch: Request the next page in the background while the
+                         current page is being consumed.
+        :type prefetch: bool, optional
+        :param \*\*kwargs: Keyword arguments to be passed to function.
+        :returns: An iterator of non-empty pages (ResponseList).
+        :rtype: iterator
+        :raises: :class:`PureError`
+            - If a call to retrieve a page fails.
+        .. note::
+            Requires use of REST API 1.7 or later.
+            Only one page, plus the prefetched page, is held at a time.
+            Closing the iterator stops the paging, a prefetched page that is
+            still in flight is discarded.
+        """
+        def get_page(token):
+            page_kwargs = dict(kwargs, limit=page_size)
+            if token:
+                page_kwargs["token"] = token
+            return function(**page_kwargs)
+
+        executor = ThreadPoolExecutor(max_workers=1) if prefetch else None
+        try:
+            page = get_page(None)
+            while page:
+                token = page.headers.get("x-next-token")
+                next_page = None
+                if token and executor is not None:
+                    next_page = executor.submit(get_page, token)
+                yield page
+                if not token:
+                    return
+                page = next_page.result() if next_page else get_page(token)
+        finally:
+            if executor is not None:
+                executor.shutdown(wait=False)
+
+    def iter_items(self, function, page_size=DEFAULT_PAGE_SIZE,
+                   prefetch=True, **kwargs):
+        """Return an iterator over the elements of a REST list operation.
+        :param function: FlashArray function that accepts limit as an argument.
+        :param page_size: Number of elements to retrieve per call.
+        :type page_size: int, optional
+        :param prefetch: Request the next page in the background while the
+                         current page is being consumed.
+        :type prefetch: bool, optional
+        :param \*\*kwargs: Keyword arguments to be passed to function.
+        :returns: An iterator of dictionaries, one per element.
+        :rtype: iterator
+        .. note::
+            See :meth:`iter_pages`.
+        """
+        for page in self.iter_pages(function, page_size, prefetch, **kwargs):
+            for item in page:
+                yield item
+
+    def iter_volumes(self, page_size=DEFAULT_PAGE_SIZE, prefetch=True,
+                     **kwargs):
+        """Return an iterator over dictionaries describing each volume.
+        :param page_size: Number of volumes to retrieve per call.
+        :type page_size: int, optional
+        :param prefetch: Request the next page in the background while the
+                         current page is being consumed.
+        :type prefetch: bool, optional
+        :param \*\*kwargs: See the REST API Guide on your array for the
+                           documentation on the request:
+                           **GET volume**
+        :type \*\*kwargs: optional
+        :returns: An iterator of dictionaries describing each volume.
+        :rtype: iterator
+        .. note::
+            Requires use of REST API 1.7 or later.
+        """
+        return self.iter_items(self.list_volumes, page_size, prefetch,
+                               **kwargs)
+
+    def find_volume(self, match, page_size=DEFAULT_PAGE_SIZE, prefetch=True,
+                    **kwargs):
+        """Return the first volume for which match returns True.
+        :param match: Function called with each volume dictionary.
+        :param page_size: Number of volumes to retrieve per call.
+        :type page_size: int, optional
+        :param prefetch: Request the next page in the background while the
+                         current page is being consumed.
+        :type prefetch: bool, optional
+        :param \*\*kwargs: See the REST API Guide on your array for the
+                           documentation on the request:
+                           **GET volume**
+        :type \*\*kwargs: optional
+        :returns: A dictionary describing the volume, or None if no volume
+                  matches.
+        :rtype: ResponseDict
+        .. note::
+            Requires use of REST API 1.7 or later.
+            No further pages are requested once a match is found.
+        """
+        volumes = self.iter_volumes(page_size, prefetch, **kwargs)
+        try:
+            for volume in volumes:
+                if match(volume):
+                    return ResponseDict(volume)
+            return None
+        finally:
+            volumes.close()
+
 
 class ResponseList(list):
     """List type returned by FlashArray object.
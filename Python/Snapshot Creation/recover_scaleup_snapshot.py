@@ -10,14 +10,17 @@
 
 import sys
 import argparse
-import paramiko
 import re
 import purestorage_custom
 import time
 from passwords import DB_Password, OS_Password, SID_Password, vCenter_Password, FlashArray_Password
-from hdbcli import dbapi
+from saphana_connection import SAPHANAConnection
+from saphana_topology import probe_saphana_topology
 from datetime import datetime
 from vsphere import vsphere_get_vvol_disk_identifiers
+from host_connections import SSHConnectionPool
+from device_resolver import resolve_mount_devices
+from volume_resolver import normalize_serial
 
 #Arguments
 parser = argparse.ArgumentParser(description='Process the recovery of an SAP \
@@ -55,6 +58,10 @@ parser.add_argument('-vcu','--vcenteruser', help='The Username of a user for the
     Server managing the SAP HANA VM ', default=None)
 parser.add_argument('-vcp','--vcenterpassword', type=vCenter_Password, help='The Password of a user for the vCenter\
     Server managing the SAP HANA VM ', default=vCenter_Password.DEFAULT_vCenter_Password)
+parser.add_argument('-dt','--devicetimeout', type=int, help='The maximum number of seconds to wait for \
+    the operating system to present or remove a device after a rescan', default=120)
+parser.add_argument('-it','--instancetimeout', type=int, help='The maximum number of seconds to wait for \
+    the SAP HANA instance to stop or start', default=1800)
 parser.add_argument('--version', action='version', version='%(prog)s 0.5')
 
 args = parser.parse_args()
@@ -73,6 +80,8 @@ overwritevolume = args.overwritevolume
 vcenteraddress = args.vcenteraddress
 vcenteruser = args.vcenteruser
 vcenterpassword = args.vcenterpassword.value
+devicetimeout = args.devicetimeout
+instancetimeout = args.instancetimeout
 
 # hostaddress = ""
 # instancenumber = ""
@@ -88,9 +97,32 @@ port = "13"
 # vcenteraddress = ""
 # vcenteruser = ""
 # vcenterpassword = ""
+# devicetimeout = 120
+# instancetimeout = 1800
 # sidadmpassword = ""
 # overwritevolume = False
 
+# SAP HANA connections are opened once per port and closed when the run finishes
+saphana_connections = {}
+# The SAP HANA topology is only queried once per run
+saphana_topology = None
+# product_uuid is only readable by root , sudo is used if the operating system user is not root
+VM_UUID_COMMAND = "cat /sys/class/dmi/id/product_uuid 2>/dev/null || sudo -n /usr/bin/cat /sys/class/dmi/id/product_uuid"
+# SSH connections to each host are opened once and reused for the whole run
+ssh_pool = SSHConnectionPool()
+# Volume snapshots are created with the suffix SAPHANA-<backup id> , the volume name and suffix are separated by a dot
+SNAPSHOT_SUFFIX = "SAPHANA-"
+SNAPSHOT_SUFFIX_PATTERN = re.compile(r'\.' + SNAPSHOT_SUFFIX + r'(\d+)$')
+# The snapshots on the FlashArray are only listed once per run
+snapshot_index = None
+# Waiting for a device starts with a short delay between checks which is doubled up to the maximum
+DEVICE_WAIT_INITIAL_DELAY = 0.5
+DEVICE_WAIT_MAX_DELAY = 8
+# The instance state is checked every INSTANCE_WAIT_INITIAL_DELAY seconds at first , the delay grows while the
+# state is unchanged and is reset whenever a process changes state
+INSTANCE_WAIT_INITIAL_DELAY = 1
+INSTANCE_WAIT_MAX_DELAY = 15
+
 # This method is responsible for ensuring that the version of Python be used is 3 or higher
 def check_pythonversion():
     if sys.version_info[0] < 3:
@@ -98,97 +130,198 @@ def check_pythonversion():
 
 # This method takes any SQL command for SAP HANA and sends it to the relevant service. 
 # The port number is included to ensure connections are made to the SYSTEMDB
+# A single connection is kept open for each port and reused for the whole run
 def execute_saphana_command(command, port_number):
     portvalue = "3" + str(instancenumber) + str(port_number)
-    connection = dbapi.connect(address=hostaddress,
-                port=portvalue,
-                user=databaseuser,
-                password=databasepassword)
-    if(connection.isconnected):
-        cursor = connection.cursor()
-        cursor.execute(command)
-        responses = list()
-        if cursor.description is not None:
-            for row in cursor:
-                responses.append(row)
-            return responses
-        else:
-            pass
-    else:
-            print("Database connection not possible")
+    connection = saphana_connections.get(portvalue)
+    if connection is None:
+        connection = saphana_connections.setdefault(portvalue, SAPHANAConnection(hostaddress, portvalue, \
+            databaseuser, databasepassword))
+    return connection.execute(command)
+
+# Stopping and recovering the instance ends every open session , the connections are closed so that the next
+# SQL command , such as the tenant recovery , opens a fresh session rather than relying on the lost one being noticed
+def close_saphana_connections():
+    for connection in list(saphana_connections.values()):
+        connection.close()
+    saphana_connections.clear()
+
+# The SID , persistence locations , attached storage and nameserver are read from SAP HANA in one query and reused for the run
+def get_saphana_topology():
+    global saphana_topology
+    if saphana_topology is None:
+        saphana_topology = probe_saphana_topology(lambda command: execute_saphana_command(command, port))
+    return saphana_topology
 
 # When the instance ID is required this method returnes the 3 character SID of the HANA platform
 def get_saphana_instanceid():
-    hdbsqlGetSAPHANAInstanceID = "SELECT VALUE from SYS.M_SYSTEM_OVERVIEW WHERE NAME = 'Instance ID'"
-    instanceid =  execute_saphana_command(hdbsqlGetSAPHANAInstanceID,port)
-    return instanceid
+    return get_saphana_topology().sid
+
+# Only the volume being recovered is looked up , the array filters on the serial number and returns just that volume
+def get_volume_name_by_serial(array, serialno):
+    volume = array.get_volume_by_serial(normalize_serial(serialno), fields=['name'])
+    if volume is None:
+        return None
+    return volume.get('name')
 
 # When bash commands need to be run this method is triggered
+# The SSH transport to the host is opened once and shared by every command through the connection pool
+# Commands for the local machine , run as the user running the script , are run directly without SSH
 def prepare_ssh_connection():
-    sshclient = paramiko.SSHClient()
-    sshclient.set_missing_host_key_policy(paramiko.AutoAddPolicy())
-    sshclient.connect(
-        hostaddress,
-        port=22,
-        username=operatingsystemuser,
-        password=operatingsystempassword
-    )
-    return sshclient
+    return ssh_pool.connection(hostaddress, operatingsystemuser, operatingsystempassword)
 
 # When bash commands for the SID<adm> environment need to be run this method is triggered
 def prepare_ssh_connection_sidadm(user):
-    sshclient = paramiko.SSHClient()
-    sshclient.set_missing_host_key_policy(paramiko.AutoAddPolicy())
-    sshclient.connect(
-        hostaddress,
-        port=22,
-        username=user,
-        password=sidadmpassword
-    )
-    return sshclient
-
-# In order to match the volume presented to the operating system the serial number is identified from the mount point
-# udev is queried to look at volume information
-def get_volume_serialno(volume_mount):
+    return ssh_pool.connection(hostaddress, user, sidadmpassword)
+
+# A virtual machine can read its own BIOS UUID , this lets vCenter find the virtual machine directly instead of searching the inventory
+# None is returned if the UUID cannot be read , in which case the inventory is searched
+def get_vm_uuid():
     sshclient = prepare_ssh_connection()
-    get_volumemountpoint_command = "df -h | grep " + str(volume_mount)
-    stdin, stdout, stderr = sshclient.exec_command(get_volumemountpoint_command)
+    stdin, stdout, stderr = sshclient.exec_command(VM_UUID_COMMAND)
     opt = stdout.readlines()
-    parsedvolume_location = re.search("([^[']\S+)",str(opt))
-    get_volumeserialno_command = "udevadm info --query=all --name=" + \
-        str(parsedvolume_location.group()) + " | grep DM_SERIAL"
-    stdin, stdout, stderr = sshclient.exec_command(get_volumeserialno_command)
-    opt = stdout.readlines()
-    volumeserial_toparse = opt
     sshclient.close()
-    volumeserial_toparse = re.split("=",str(volumeserial_toparse))
-    volumeserial_toparse = volumeserial_toparse[1]
-    volumeserial_toparse = re.split("\\\\",str(volumeserial_toparse))
-    volumeserial = volumeserial_toparse[0]
+    if len(opt) == 0 or len(opt[0].strip()) == 0:
+        return None
+    return opt[0].strip()
+
+# The block device and world wide ID behind a mount point are read from /proc and /sys on the host in a single command
+def get_mount_device(volume_mount):
+    sshclient = prepare_ssh_connection()
+    device = resolve_mount_devices(sshclient, [volume_mount]).get(str(volume_mount))
+    sshclient.close()
+    if device is None:
+        raise NameError('No block device could be found for ' + str(volume_mount))
+    return device
+
+# In order to match the volume presented to the operating system the world wide ID is identified from the mount point
+def get_volume_serialno(volume_mount):
+    volumeserial = get_mount_device(volume_mount).get('wwid')
+    if volumeserial is None:
+        raise NameError('The world wide ID of the volume mounted at ' + str(volume_mount) + ' could not be found')
     return volumeserial
 
 # When and if the volume conforms to a non FlashArray world wide id (for example with VMware vvols) this method can be 
 # used to retrieve the device mounted at the relevant location
 def get_volume_device(volume_mount):
-    sshclient = prepare_ssh_connection()
-    get_volumemountpoint_command = "df -h | grep " + str(volume_mount)
-    stdin, stdout, stderr = sshclient.exec_command(get_volumemountpoint_command)
+    device = get_mount_device(volume_mount)
+    if device.get('dm_name') is not None:
+        return "/dev/mapper/" + device.get('dm_name')
+    return device.get('device')
+
+# After a rescan the udev event queue is settled and the device node is checked , this is repeated with a growing
+# delay until the device is present ( or removed ) or the device timeout has passed
+# The time waited is reported and returned
+def wait_for_device(sshclient, device_path, present=True):
+    expected_state = "present" if present else "absent"
+    start = time.monotonic()
+    delay = DEVICE_WAIT_INITIAL_DELAY
+    while True:
+        remaining = max(1, int(devicetimeout - (time.monotonic() - start)))
+        check_device_string = "udevadm settle --timeout=" + str(remaining) + " ; test -b " + device_path + \
+            " && echo present || echo absent"
+        stdin, stdout, stderr = sshclient.exec_command(check_device_string)
+        opt = stdout.readlines()
+        waited = time.monotonic() - start
+        if len(opt) > 0 and opt[-1].strip() == expected_state:
+            print("Device " + device_path + " " + expected_state + " after " + "{:.1f}".format(waited) + " seconds")
+            return waited
+        if waited + delay > devicetimeout:
+            raise NameError('The device ' + device_path + ' was not ' + expected_state + ' after ' + \
+                str(devicetimeout) + ' seconds')
+        time.sleep(delay)
+        delay = min(delay * 2, DEVICE_WAIT_MAX_DELAY)
+
+# The SCSI path devices behind a device and their host:channel:target:lun addresses are read from sysfs
+# A multipath device lists its paths as slaves , any other block device is its own single path
+def get_device_paths(sshclient, device_path):
+    get_device_paths_string = "dev=$(basename $(readlink -f " + device_path + ")) ; " + \
+        "paths=$(ls /sys/block/$dev/slaves 2>/dev/null) ; [ -n \"$paths\" ] || paths=$dev ; " + \
+        "for path in $paths ; do [ -e /sys/block/$path/device ] && " + \
+        "echo $path $(basename $(readlink -f /sys/block/$path/device)) ; done"
+    stdin, stdout, stderr = sshclient.exec_command(get_device_paths_string)
+    opt = stdout.readlines()
+    device_paths = []
+    for line in opt:
+        fields = line.split()
+        if len(fields) == 2 and re.match(r"^\d+:\d+:\d+:\d+$", fields[1]):
+            address = fields[1].split(":")
+            device_paths.append({'device': fields[0], 'host': address[0], 'channel': address[1],
+                'target': address[2], 'lun': address[3]})
+    return device_paths
+
+# The device commands are run one after the other and stop at the first one that fails , the failure is reported
+# with its error output rather than only showing up later as a device that never appears
+def run_device_commands(sshclient, commands):
+    device_command_string = " && ".join(commands) + " && echo completed"
+    stdin, stdout, stderr = sshclient.exec_command(device_command_string)
     opt = stdout.readlines()
-    parsed_device_location = re.search("([^[']\S*)",str(opt))
-    parsed_device_location = parsed_device_location.group()
-    return parsed_device_location
+    if len(opt) == 0 or opt[-1].strip() != "completed":
+        raise NameError('The operating system storage could not be updated : ' + "".join(stderr.readlines()).strip())
+
+# The multipath map of a device is flushed and reloaded by its map name , which is the WWID or an alias
+def get_device_map_name(device_path):
+    if device_path.startswith("/dev/mapper/"):
+        return device_path[len("/dev/mapper/"):]
+    return None
+
+# rescan-scsi-bus.sh is limited to a single SCSI address with its host , channel , id and LUN options , so only that
+# device is scanned. Every address is only scanned once
+def get_scsi_scan_commands(options, addresses):
+    scan_commands = []
+    for host, channel, target, lun in addresses:
+        scan_command = "sudo /usr/bin/rescan-scsi-bus.sh " + options + "--hosts=" + str(int(host)) + \
+            " --channels=" + str(int(channel)) + " --ids=" + str(int(target)) + " --luns=" + str(int(lun))
+        if scan_command not in scan_commands:
+            scan_commands.append(scan_command)
+    return scan_commands
+
+# The host , channel , id and LUN of every path of a device
+def get_device_path_addresses(device_paths):
+    return [(path.get('host'), path.get('channel'), path.get('target'), path.get('lun')) for path in device_paths]
+
+# Only the paths of the removed volume are deleted and only its multipath map is flushed
+# If the paths are not known the whole SCSI bus is rescanned instead
+def remove_device_paths(sshclient, device_path, device_paths):
+    if len(device_paths) == 0:
+        run_device_commands(sshclient, ["sudo /usr/bin/rescan-scsi-bus.sh -r"])
+        return
+    remove_commands = []
+    map_name = get_device_map_name(device_path)
+    if map_name is not None:
+        remove_commands.append("sudo /sbin/multipath -f " + map_name)
+    remove_commands.extend(get_scsi_scan_commands("-r ", get_device_path_addresses(device_paths)))
+    run_device_commands(sshclient, remove_commands)
+
+# The new volume is scanned for with its LUN ID on the same SCSI host , channel and target as the paths of the
+# volume it replaces , after which only its multipath map is created
+# If the paths are not known the whole SCSI bus is rescanned instead
+def add_device_paths(sshclient, wwid, device_paths, luns):
+    if len(device_paths) == 0 or len(luns) == 0:
+        run_device_commands(sshclient, ["sudo /usr/bin/rescan-scsi-bus.sh -a"])
+        return
+    addresses = [(path.get('host'), path.get('channel'), path.get('target'), lun) for path in device_paths for lun in luns]
+    scan_commands = get_scsi_scan_commands("", addresses)
+    scan_commands.append("sudo /sbin/multipath " + wwid)
+    run_device_commands(sshclient, scan_commands)
+
+# An overwritten volume keeps its paths , only those paths are checked for changes and its multipath map reloaded
+# If the paths are not known the whole SCSI bus is rescanned instead
+def rescan_device_paths(sshclient, device_path, device_paths):
+    if len(device_paths) == 0:
+        run_device_commands(sshclient, ["sudo /usr/bin/rescan-scsi-bus.sh -a"])
+        return
+    rescan_commands = get_scsi_scan_commands("-s ", get_device_path_addresses(device_paths))
+    map_name = get_device_map_name(device_path)
+    if map_name is not None:
+        rescan_commands.append("sudo /sbin/multipath -r " + map_name)
+    run_device_commands(sshclient, rescan_commands)
 
 # SAP HANA keeps track of the data and log volumes , this method will query the platform to return the location of the log and data volumes 
 # When using an application consistent data snapshot only the data volume is needed as the process will trigger a savepoint 
 # Recovery will nullify all transaction logs 
 def get_saphana_data_volume_mount():
-    hdbGetHANADataVolumeMount = "SELECT VALUE FROM M_INIFILE_CONTENTS WHERE FILE_NAME = \
-        'global.ini' AND SECTION = 'persistence' AND KEY = 'basepath_datavolumes'  AND VALUE NOT LIKE '$%'"
-    data_volume = execute_saphana_command(hdbGetHANADataVolumeMount, port)
-    instanceid = get_saphana_instanceid()
-    data_volume = data_volume[0].column_values
-    data_volume = str(data_volume[0]).replace("/" + str(instanceid[0].column_values[0]), "")
-    return data_volume
+    return get_saphana_topology().data_volume_mount()
 
 # The backup catalog is used to decide which backup will be used. Only confirmed application consistent snapshots will be shown
 def get_saphana_backup_catalog():
@@ -207,38 +340,81 @@ def get_saphana_backup_catalog():
         catalogcounter+=1
     return catalogitems
 
+# All SAP HANA data snapshots on the FlashArray are listed with a single call and indexed by the backup ID in their
+# suffix , the index is only built once and then answers the check for every catalog entry
+def get_snapshot_index():
+    global snapshot_index
+    if snapshot_index is None:
+        array = purestorage_custom.FlashArray(flasharray,flasharrayuser, flasharraypassword,verify_https=False)
+        snapshot_index = {}
+        for snap in array.list_snapshots_by_suffix(SNAPSHOT_SUFFIX + "*"):
+            match = SNAPSHOT_SUFFIX_PATTERN.search(str(snap.get("name")))
+            if match is not None:
+                snapshot_index.setdefault(match.group(1), snap)
+    return snapshot_index
+
 # Before proceeding with any operations the storage snapshot needs to be verified to be on the FlashArray 
 def check_storage_snapshot(backupid):
-    array = purestorage_custom.FlashArray(flasharray,flasharrayuser, flasharraypassword,verify_https=False)
-    volumes =  array.list_volumes()
-    for key in volumes:
-        volname = key.get("name")
-        snaps =  array.get_volume(volname, snap=True)
-        for snap in snaps:
-            found = str(backupid) in snap.get("name")
-            if found:
-                return snap
+    return get_snapshot_index().get(str(backupid))
+
+# sapcontrol GetProcessList prints a header line followed by one line per process in the form
+# name, description, dispstatus, textstatus, starttime, elapsedtime, pid
+# The status of every process is returned keyed by process name
+def get_saphana_process_list(sshclient):
+    get_instance_state_string = "/usr/sap/hostctrl/exe/sapcontrol -nr " + instancenumber + \
+        " -function GetProcessList"
+    stdin, stdout, stderr = sshclient.exec_command(get_instance_state_string)
+    opt = stdout.readlines()
+    processes = {}
+    header_found = False
+    for line in opt:
+        fields = [field.strip() for field in line.split(",")]
+        if not header_found:
+            header_found = fields[0:4] == ['name', 'description', 'dispstatus', 'textstatus']
+            continue
+        if len(fields) >= 4:
+            processes[fields[0]] = {'description': fields[1], 'dispstatus': fields[2], 'textstatus': fields[3]}
+    return processes
+
+# The instance is in the wanted state once the HDB daemon reports it , the process list is polled with a growing
+# delay which drops back to the shortest delay as soon as any process changes state
+# The time waited is reported and returned , if the timeout passes the state of every process is reported
+def wait_for_instance_state(sshclient, textstatus, dispstatus):
+    start = time.monotonic()
+    delay = INSTANCE_WAIT_INITIAL_DELAY
+    previous_processes = None
+    while True:
+        processes = get_saphana_process_list(sshclient)
+        daemon = processes.get('hdbdaemon')
+        waited = time.monotonic() - start
+        if daemon is not None and daemon.get('textstatus') == textstatus and daemon.get('dispstatus') == dispstatus:
+            print("SAP HANA instance " + textstatus + " after " + "{:.1f}".format(waited) + " seconds")
+            return waited
+        if waited + delay > instancetimeout:
+            process_states = ", ".join(name + " " + process.get('dispstatus') + " " + process.get('textstatus') \
+                for name, process in processes.items())
+            raise NameError('The SAP HANA instance was not ' + textstatus + ' after ' + str(instancetimeout) + \
+                ' seconds , process states : ' + process_states)
+        if processes != previous_processes:
+            delay = INSTANCE_WAIT_INITIAL_DELAY
+        else:
+            delay = min(delay * 2, INSTANCE_WAIT_MAX_DELAY)
+        previous_processes = processes
+        time.sleep(delay)
 
 # During the recovery process the instance needs to be fully stopped
 def stop_saphana_instance(mount_point):
     sshclient = prepare_ssh_connection()
     shutdown_instance_string = "/usr/sap/hostctrl/exe/sapcontrol -nr " + instancenumber + \
         " -function Stop"
-    get_instance_state_string = "/usr/sap/hostctrl/exe/sapcontrol -nr " + instancenumber + \
-        " -function GetProcessList"
     umount_data_volume = "umount " + mount_point
+    close_saphana_connections()
     stdin, stdout, stderr = sshclient.exec_command(shutdown_instance_string)
     opt = stdout.readlines()
-    running = True
-    while(running):
-        stdin, stdout, stderr = sshclient.exec_command(get_instance_state_string)
-        check = stdout.readlines()
-        checkval = "hdbdaemon, HDB Daemon, GRAY, Stopped"
-        found = checkval in check[5]
-        if(found):
-            stdin, stdout, stderr = sshclient.exec_command(umount_data_volume)
-            sshclient.close()
-            running = False
+    wait_for_instance_state(sshclient, "Stopped", "GRAY")
+    stdin, stdout, stderr = sshclient.exec_command(umount_data_volume)
+    opt = stdout.readlines()
+    sshclient.close()
 
 # During recovery the volume will be overwritten with the storage snapshot 
 # In a vvol scenario without multipathing it may be necessary to know where the volume needs to be mounted to
@@ -246,7 +422,6 @@ def stop_saphana_instance(mount_point):
 def restore_overwrite_volume(snapshot, mount_point, backupid, serialno, virtual_disk, data_vol_mount_point,
     block_device):
     array = purestorage_custom.FlashArray(flasharray,flasharrayuser, flasharraypassword,verify_https=False)
-    volumes =  array.list_volumes()
     new_volume = None
     if(virtual_disk):
         vm_disk_info = None
@@ -255,7 +430,7 @@ def restore_overwrite_volume(snapshot, mount_point, backupid, serialno, virtual_
         else:
             raise NameError('The volume has been detected to be a virtual disk but no vCenter credentials \
                 have been supplied to further parse the request')
-        vm_disk_info = vsphere_get_vvol_disk_identifiers(serialno,vcenter_dict)
+        vm_disk_info = vsphere_get_vvol_disk_identifiers(serialno,vcenter_dict,get_vm_uuid())
         if vm_disk_info is not None:
             volume = array.list_virtual_volume(vm_disk_info.get('backingObjectId'))
             if(volume.__len__() != 0):
@@ -264,38 +439,28 @@ def restore_overwrite_volume(snapshot, mount_point, backupid, serialno, virtual_
                         volname = attr.get('name')
                         vol = array.get_volume(volname)
                         vvolvolserial = vol.get('serial')
-                        volumes =  array.list_volumes()
-                        for key in volumes:
-                            volname = key.get("name")
-                            volserial = str(key.get("serial")).lower()
-                            found = volserial.lower() in vvolvolserial.lower()
-                            if found:
-                                new_volume = array.copy_volume(snapshot.get("name"), volname, overwrite=True)
-                                break
+                        volname = get_volume_name_by_serial(array, vvolvolserial)
+                        if volname is not None:
+                            new_volume = array.copy_volume(snapshot.get("name"), volname, overwrite=True)
+                            break
     else:
-        for key in volumes:
-            volname = key.get("name")
-            volserial = str(key.get("serial")).lower()
-            found = volserial in serialno 
-            if(found):
-                new_volume = array.copy_volume(snapshot.get("name"), volname, overwrite=True)
-                break
+        volname = get_volume_name_by_serial(array, serialno)
+        if(volname is not None):
+            new_volume = array.copy_volume(snapshot.get("name"), volname, overwrite=True)
         if(new_volume is None):
             raise NameError('There was an error location the source volume on the array')
-    #operating system rescan for new device 
+    #operating system rescan of the overwritten device 
     sshclient = prepare_ssh_connection()
-    rescan_scsi_bus_add_string = "sudo rescan-scsi-bus.sh -a"
-    stdin, stdout, stderr = sshclient.exec_command(rescan_scsi_bus_add_string)
-    time.sleep(30)
-    opt = stdout.readlines()
-    #mount new volume 
-    device_mount_string = None
     if(data_vol_mount_point is not None and block_device is not None):
-         device_mount_string = "mount " + block_device + " " + mount_point
+         device_path = block_device
     else:
-        device_mount_string = "mount /dev/mapper/3624a9370" + new_volume.get("serial").lower() + " " + mount_point
+        device_path = "/dev/mapper/3624a9370" + new_volume.get("serial").lower()
+    rescan_device_paths(sshclient, device_path, get_device_paths(sshclient, device_path))
+    #mount new volume 
+    wait_for_device(sshclient, device_path)
+    device_mount_string = "mount " + device_path + " " + mount_point
     stdin, stdout, stderr = sshclient.exec_command(device_mount_string)
-    time.sleep(30)
+    opt = stdout.readlines()
     sshclient.close()
     returned_serial_number = get_volume_serialno(mount_point)
     foundfinal = returned_serial_number in serialno
@@ -304,70 +469,84 @@ def restore_overwrite_volume(snapshot, mount_point, backupid, serialno, virtual_
     else:
         return False
 
+# The hosts and host groups the source volume is connected to are read from the volume itself rather than by
+# searching the connections of every host on the array. Host group connections are returned once for every
+# member host , each host group is only listed once
+def get_volume_connections(array, volname):
+    hosts = [connection.get("host") for connection in array.list_volume_private_connections(volname)]
+    hgroups = []
+    for connection in array.list_volume_shared_connections(volname):
+        if connection.get("hgroup") not in hgroups:
+            hgroups.append(connection.get("hgroup"))
+    return hosts, hgroups
+
 # During recovery the volume will be copied to a new volume and that volume mounted to the relevant mount point 
-def restore_copyvolume(snapshot, mount_point, backupid, serialno):
+# The new volume takes over every host and host group connection of the existing data volume
+def restore_copyvolume(snapshot, mount_point, backupid, serialno, block_device):
     array = purestorage_custom.FlashArray(flasharray,flasharrayuser, flasharraypassword,verify_https=False)
+    volume = array.get_volume_by_serial(normalize_serial(serialno), fields=['name'])
+    if(volume is None):
+        raise NameError('There was an error location the source volume on the array')
+    hosts, hgroups = get_volume_connections(array, volume.get("name"))
+    if(len(hosts) == 0 and len(hgroups) == 0):
+        raise NameError('The source volume ' + volume.get("name") + ' is not connected to any host or host group')
     new_volume = array.copy_volume(snapshot.get("name"), snapshot.get("source") + "-" + str(backupid))
-    hosts = array.list_hosts()
+    new_wwid = "3624a9370" + new_volume.get("serial").lower()
+    #the paths of the existing data volume are recorded before it is disconnected
+    sshclient = prepare_ssh_connection()
+    device_paths = get_device_paths(sshclient, block_device)
+    #disconnect existing data volume from hosts and host groups
     for host in hosts:
-        host_volumes = array.list_host_connections(host.get("name"))
-        for hostvol in host_volumes:
-            if(hostvol.get("vol") != 'pure-protocol-endpoint'):
-                volume = array.get_volume(hostvol.get("vol"))
-                found = str(volume.get("serial")).lower() in serialno
-                if found:
-                    #disconnect existing data volume from host 
-                    array.disconnect_host(host.get("name"), volume.get("name"))
-                    #operating system remove device maps
-                    sshclient = prepare_ssh_connection()
-                    rescan_scsi_bus_remove_string = "sudo rescan-scsi-bus.sh -r"
-                    stdin, stdout, stderr = sshclient.exec_command(rescan_scsi_bus_remove_string)
-                    time.sleep(30)
-                    opt = stdout.readlines()
-                    #connect new data volume to host
-                    array.connect_host(host.get("name"), new_volume.get("name"))
-                    #operating system rescan for new device 
-                    rescan_scsi_bus_add_string = "sudo rescan-scsi-bus.sh -a"
-                    stdin, stdout, stderr = sshclient.exec_command(rescan_scsi_bus_add_string)
-                    time.sleep(30)
-                    opt = stdout.readlines()
-                    #mount new volume 
-                    device_mount_string = "mount /dev/mapper/3624a9370" + new_volume.get("serial").lower() + " " + mount_point
-                    stdin, stdout, stderr = sshclient.exec_command(device_mount_string)
-                    time.sleep(30)
-                    sshclient.close()
-                    returned_serial_number = get_volume_serialno(mount_point)
-                    foundfinal = str(new_volume.get("serial")).lower() in returned_serial_number
-                    if(foundfinal):
-                        return True
-                    else:
-                        return False
+        array.disconnect_host(host, volume.get("name"))
+    for hgroup in hgroups:
+        array.disconnect_hgroup(hgroup, volume.get("name"))
+    #operating system remove device maps
+    remove_device_paths(sshclient, block_device, device_paths)
+    wait_for_device(sshclient, block_device, present=False)
+    #connect new data volume to the same hosts and host groups
+    luns = []
+    for host in hosts:
+        connection = array.connect_host(host, new_volume.get("name"))
+        if connection.get("lun") not in luns:
+            luns.append(connection.get("lun"))
+    for hgroup in hgroups:
+        connection = array.connect_hgroup(hgroup, new_volume.get("name"))
+        if connection.get("lun") not in luns:
+            luns.append(connection.get("lun"))
+    #operating system rescan for new device 
+    add_device_paths(sshclient, new_wwid, device_paths, [lun for lun in luns if lun is not None])
+    #mount new volume , the multipath map is found by its WWID whether or not it is named after it
+    device_path = "/dev/disk/by-id/dm-uuid-mpath-" + new_wwid
+    wait_for_device(sshclient, device_path)
+    device_mount_string = "mount " + device_path + " " + mount_point
+    stdin, stdout, stderr = sshclient.exec_command(device_mount_string)
+    opt = stdout.readlines()
+    sshclient.close()
+    returned_serial_number = get_volume_serialno(mount_point)
+    foundfinal = str(new_volume.get("serial")).lower() in returned_serial_number
+    if(foundfinal):
+        return True
+    else:
+        return False
+
 # Once each storage operation has been completed SAP HANA can be instructed to restore the System Database
 def restore_systemdb(sid):
-    sidadmuser = sid[0].column_values[0].lower() + "adm"
+    sidadmuser = sid.lower() + "adm"
     sshclient = prepare_ssh_connection_sidadm(sidadmuser)
-    recover_systemdb_string = "/usr/sap/" + sid[0].column_values[0] + "/HDB" + instancenumber + \
-        "/HDBSettings.sh /usr/sap/" + sid[0].column_values[0] + "/HDB" + instancenumber + \
+    recover_systemdb_string = "/usr/sap/" + sid + "/HDB" + instancenumber + \
+        "/HDBSettings.sh /usr/sap/" + sid + "/HDB" + instancenumber + \
         "/exe/python_support/recoverSys.py --command=\"RECOVER DATA  USING SNAPSHOT  CLEAR LOG\""
     stdin, stdout, stderr = sshclient.exec_command(recover_systemdb_string)
     time.sleep(10)
     opt = stdout.readlines()
     sshclient.close()
+    close_saphana_connections()
 
 # Before any proceeding operation can occur after recovering the system database the instance must be fully running
 def check_running_instance():
     sshclient = prepare_ssh_connection()
-    get_instance_state_string = "/usr/sap/hostctrl/exe/sapcontrol -nr " + instancenumber + \
-        " -function GetProcessList"
-    running = True
-    while(running):
-        stdin, stdout, stderr = sshclient.exec_command(get_instance_state_string)
-        check = stdout.readlines()
-        checkval = "hdbdaemon, HDB Daemon, GREEN, Running"
-        found = checkval in check[5]
-        if(found):
-            sshclient.close()
-            running = False
+    wait_for_instance_state(sshclient, "Running", "GREEN")
+    sshclient.close()
 
 # For the final restore operation each tenant is retrieved before running the restore operation
 def get_tenants_to_restore():
@@ -386,16 +565,17 @@ try:
         print("|    SAP HANA Backup Catalog : Data Snapshots    |")
         print("|          Select a Catalog ID to restore        |")
         print(" ------------------------------------------------ ") 
-        print(" -------------         ----------          ------")
-        print("| Catalog ID |        | BackupID |        | Date |")
-        print(" -------------         ----------          ------")
+        print(" -------------         ----------          ------          ----------")
+        print("| Catalog ID |        | BackupID |        | Date |        | Snapshot |")
+        print(" -------------         ----------          ------          ----------")
 
         for backups in catalog:
             catalogid = str(backups.get('catalogid'))
             backupid = str(backups.get('backupid'))
             date = str(backups.get('date'))
+            snapshot_present = "present" if check_storage_snapshot(backupid) is not None else "missing"
             print(str("      " + catalogid + "               " + str(backupid) + \
-                "         " + str(date)))
+                "         " + str(date) + "         " + snapshot_present))
         choice = input("Enter the catalog ID of the backup to restore --> ")
         for backups in catalog:
             if(backups.get('catalogid') == int(choice)):
@@ -409,7 +589,8 @@ try:
                     serial_number = get_volume_serialno(data_volume)
                     # Check if the volume is a vdisk or a direct attached disk
                     virtual_disk = False
-                    volume_device = None
+                    # The block device is resolved while the data volume is still mounted
+                    volume_device = get_volume_device(data_volume)
                     vendor_string = serial_number[0 : 8]
                     # This is a disk directly attached to the host
                     if(vendor_string == '3624a937'):
@@ -417,7 +598,6 @@ try:
                     elif(vendor_string == '36000c29'):
                         virtual_disk = True
                         overwritevolume = True
-                        volume_device = get_volume_device(data_volume)
                     print(" ------------------------------------------------ ")
                     print("|        This is a disruptive process!!!         |")
                     if(virtual_disk == True):
@@ -440,7 +620,7 @@ try:
                                 print("|        Updating operating system storage       |")
                                 print(" ------------------------------------------------ ") 
                                 restore_storage_sucess = restore_copyvolume(snap, data_volume,\
-                                    backupid, serial_number)
+                                    backupid, serial_number, volume_device)
                             else:
                                 print(" ------------------------------------------------ ")
                                 print("|          Overwriting existing volume           |")
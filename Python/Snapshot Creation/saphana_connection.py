@@ -0,0 +1,62 @@
+##################################################################################################
+#                                                                                                #
+#                  Pure Storage Inc. (2024) SAP HANA database connection helper module           #
+#         Keeps a single SYSTEMDB connection open for the run and closes it when finished        #
+#                                                                                                #
+##################################################################################################
+
+import atexit
+import threading
+from hdbcli import dbapi
+
+# The connection is opened on the first SQL command and reused for every command after that
+# Commands from several threads are serialized as an hdbcli connection is not safe for concurrent use
+class SAPHANAConnection:
+
+    def __init__(self, address, port, user, password):
+        self.address = address
+        self.port = port
+        self._user = user
+        self._password = password
+        self._connection = None
+        self._lock = threading.Lock()
+        atexit.register(self.close)
+
+    def _connect(self):
+        if self._connection is not None and self._connection.isconnected():
+            return self._connection
+        self._close_connection()
+        self._connection = dbapi.connect(address=self.address,
+                    port=self.port,
+                    user=self._user,
+                    password=self._password)
+        return self._connection
+
+    def _close_connection(self):
+        if self._connection is not None:
+            try:
+                self._connection.close()
+            except dbapi.Error:
+                pass
+            self._connection = None
+
+    def _execute(self, connection, command):
+        cursor = connection.cursor()
+        try:
+            cursor.execute(command)
+            if cursor.description is not None:
+                return list(cursor)
+            return None
+        finally:
+            cursor.close()
+
+    # A connection that is already known to be closed is replaced before the command is sent. Once a command
+    # has been sent it is never sent again , the connection can be lost after the database has already run it
+    # and statements such as BACKUP DATA CREATE SNAPSHOT or RECOVER DATA must not run twice
+    def execute(self, command):
+        with self._lock:
+            return self._execute(self._connect(), command)
+
+    def close(self):
+        with self._lock:
+            self._close_connection()
@@ -0,0 +1,75 @@
+##################################################################################################
+#                                                                                                #
+#                  Pure Storage Inc. (2024) SAP HANA topology probe module                       #
+#     Retrieves the SID , persistence locations , attached storage and master nameserver         #
+#                             of an SAP HANA system in a single query                            #
+#                                                                                                #
+##################################################################################################
+
+from typing import List, NamedTuple
+
+# Every part of the topology is returned as rows of (ITEM, HOST, NAME, VALUE) from one statement
+hdbGetSAPHANATopology = "SELECT 'SID' AS ITEM, CAST(NULL AS NVARCHAR(64)) AS HOST, \
+    CAST(NULL AS NVARCHAR(256)) AS NAME, TO_NVARCHAR(VALUE) AS VALUE FROM SYS.M_SYSTEM_OVERVIEW \
+    WHERE NAME = 'Instance ID' \
+    UNION ALL SELECT 'PERSISTENCE', NULL, KEY, VALUE FROM SYS.M_INIFILE_CONTENTS WHERE FILE_NAME = 'global.ini' \
+    AND SECTION = 'persistence' AND (KEY = 'basepath_datavolumes' OR KEY = 'basepath_logvolumes') \
+    AND VALUE NOT LIKE '$%' \
+    UNION ALL SELECT 'STORAGE', HOST, PATH, VALUE FROM SYS.M_ATTACHED_STORAGES WHERE KEY = 'WWID' \
+    UNION ALL SELECT 'NAMESERVER', HOST, NULL, NULL FROM SYS.M_SERVICES WHERE DETAIL = 'master' \
+    AND SERVICE_NAME = 'nameserver'"
+
+class AttachedStorage(NamedTuple):
+    host: str
+    path: str
+    wwid: str
+
+class SAPHANATopology(NamedTuple):
+    sid: str
+    data_basepath: str
+    log_basepath: str
+    attached_storages: List[AttachedStorage]
+    nameserver_host: str
+
+    # The persistence base paths include the SID , the mount point is the base path without it
+    def _mount_point(self, basepath):
+        if basepath is None:
+            return None
+        return str(basepath).replace("/" + self.sid, "")
+
+    def data_volume_mount(self):
+        return self._mount_point(self.data_basepath)
+
+    def log_volume_mount(self):
+        return self._mount_point(self.log_basepath)
+
+    def data_volume_storages(self):
+        return [storage for storage in self.attached_storages
+                if self.data_basepath is not None and storage.path.startswith(self.data_basepath)]
+
+    def log_volume_storages(self):
+        return [storage for storage in self.attached_storages
+                if self.log_basepath is not None and storage.path.startswith(self.log_basepath)]
+
+# This method sends the topology query through the supplied execute method and builds the topology from the rows
+# As with the individual queries the first value returned for each persistence key is used
+def probe_saphana_topology(execute):
+    rows = execute(hdbGetSAPHANATopology) or []
+    sid = None
+    persistence = {}
+    attached_storages = []
+    nameserver_host = None
+    for row in rows:
+        item, host, name, value = row[0], row[1], row[2], row[3]
+        if item == 'SID' and sid is None:
+            sid = value
+        elif item == 'PERSISTENCE':
+            persistence.setdefault(name, value)
+        elif item == 'STORAGE':
+            attached_storages.append(AttachedStorage(host, name, value))
+        elif item == 'NAMESERVER' and nameserver_host is None:
+            nameserver_host = host
+    if sid is None:
+        raise NameError('The SAP HANA instance ID could not be retrieved')
+    return SAPHANATopology(sid, persistence.get('basepath_datavolumes'), persistence.get('basepath_logvolumes'),
+                           attached_storages, nameserver_host)
@@ -0,0 +1,67 @@
+##################################################################################################
+#                                                                                                #
+#                 Pure Storage Inc. (2024) SAP HANA host topology cache module                   #
+#    Keeps the resolved mount point -> world wide ID -> FlashArray volume mapping between runs   #
+#                                                                                                #
+##################################################################################################
+
+import json
+import os
+import re
+import tempfile
+import time
+
+DEFAULT_CACHE_DIRECTORY = '/var/cache/purestorage-saphana'
+DEFAULT_TTL_SECONDS = 86400
+
+# The topology is stored as one JSON file per SID and host. Each entry records the host fingerprint
+# and the time it was written , an entry is only returned while both are still valid.
+# The fingerprint is the kernel boot id and a hash of the mount table , a reboot or any change to the
+# mounted filesystems gives the host a new fingerprint and invalidates the entry.
+# The cache is best effort , any error reading or writing it means discovery simply runs again
+class TopologyCache:
+
+    def __init__(self, cache_directory=DEFAULT_CACHE_DIRECTORY, ttl=DEFAULT_TTL_SECONDS):
+        self.cache_directory = cache_directory
+        self.ttl = ttl
+
+    def _cache_path(self, sid, host):
+        filename = re.sub('[^A-Za-z0-9_.-]', '_', str(sid) + '-' + str(host)) + '.json'
+        return os.path.join(self.cache_directory, filename)
+
+    def load(self, sid, host, fingerprint, mounts):
+        if fingerprint is None:
+            return None
+        try:
+            with open(self._cache_path(sid, host)) as cachefile:
+                entry = json.load(cachefile)
+        except (OSError, ValueError):
+            return None
+        if entry.get('fingerprint') != fingerprint:
+            return None
+        if time.time() - entry.get('created', 0) > self.ttl:
+            return None
+        volumes = entry.get('volumes') or []
+        if sorted(str(m) for m in mounts) != sorted(v.get('mountpoint') for v in volumes):
+            return None
+        return volumes
+
+    def store(self, sid, host, fingerprint, volumes):
+        if fingerprint is None:
+            return
+        entry = {'sid': sid, 'host': host, 'created': time.time(),
+                 'fingerprint': fingerprint, 'volumes': volumes}
+        try:
+            os.makedirs(self.cache_directory, mode=0o700, exist_ok=True)
+            filedescriptor, temppath = tempfile.mkstemp(dir=self.cache_directory, suffix='.tmp')
+            with os.fdopen(filedescriptor, 'w') as cachefile:
+                json.dump(entry, cachefile)
+            os.replace(temppath, self._cache_path(sid, host))
+        except OSError:
+            pass
+
+    def invalidate(self, sid, host):
+        try:
+            os.remove(self._cache_path(sid, host))
+        except OSError:
+            pass
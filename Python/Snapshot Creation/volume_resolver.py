@@ -0,0 +1,46 @@
+##################################################################################################
+#                                                                                                #
+#                  Pure Storage Inc. (2024) FlashArray volume resolver module                    #
+#     Matches the world wide ID presented to the operating system against FlashArray volumes    #
+#                                                                                                #
+##################################################################################################
+
+# Every FlashArray volume is presented to the operating system with the Pure Storage NAA prefix
+# followed by the volume serial number
+PURE_NAA_PREFIX = '3624a9370'
+
+# This method reduces a world wide ID or a FlashArray volume serial number to the bare lower case
+# serial number so that both forms can be compared directly
+def normalize_serial(serialno):
+    serialno = str(serialno).strip().lower()
+    if serialno.startswith(PURE_NAA_PREFIX):
+        serialno = serialno[len(PURE_NAA_PREFIX):]
+    return serialno
+
+# Volumes are returned as dictionaries by purestorage_custom and as objects by pypureclient
+def _volume_name_and_serial(volume):
+    if isinstance(volume, dict):
+        return volume.get('name'), volume.get('serial')
+    return volume.name, volume.serial
+
+# The index is built once from a single volume listing and then answers every serial number lookup
+# for the rest of the run without going back to the array
+class VolumeSerialIndex:
+
+    def __init__(self, volumes=()):
+        self._names_by_serial = {}
+        for volume in volumes:
+            self.add(*_volume_name_and_serial(volume))
+
+    def add(self, volname, serialno):
+        if volname is not None and serialno is not None:
+            self._names_by_serial[normalize_serial(serialno)] = volname
+
+    def get_volume_name(self, serialno):
+        return self._names_by_serial.get(normalize_serial(serialno))
+
+    def __contains__(self, serialno):
+        return normalize_serial(serialno) in self._names_by_serial
+
+    def __len__(self):
+        return len(self._names_by_serial)
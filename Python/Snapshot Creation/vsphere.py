@@ -5,74 +5,166 @@
 #                                                                                                #
 ##################################################################################################
 
+import atexit
 import requests
+import threading
 import urllib3
-from pyVmomi import vim 
+from pyVmomi import vim, vmodl
 from pyVim.connect import SmartConnect, Disconnect
 import ssl
 
-# This method logs into the vCenter server and traverses the resource tree looking for objects with the attribute 
-# "backing" to match that attribute against the serial number presented to the operating system
-def vsphere_get_vvol_disk_identifiers(serialno, vcenter):
-    requests.packages.urllib3.disable_warnings()
-    context = ssl._create_unverified_context()
-
-    si = SmartConnect(host=vcenter.get('address'),
-                    port=443,
-                    user=vcenter.get('vc_user'),
-                    pwd=vcenter.get('vc_pass'),
-                    sslContext=context)
-
-    client = si.RetrieveContent()
-
-    global vmmuuidlist 
-    vmmuuidlist = []
-    for child in client.rootFolder.childEntity:
-      if hasattr(child, 'vmFolder'):
-         datacenter = child
-         vmFolder = datacenter.vmFolder
-         vmList = vmFolder.childEntity
-         for vm in vmList:
-             PrintVmInfo(vm)   
-
-    for uuid in vmmuuidlist:
-        vm = client.searchIndex.FindByUuid(uuid=uuid, vmSearch=True)
-        config = vm.config.hardware.device
-        for conf in config:
-             if hasattr(conf, 'backing'):
-                 if hasattr(conf.backing, 'uuid'):
-                    formatteduuid = ("3" + str((conf.backing.uuid).replace("-",""))).lower()
-                    #print('comparing ' + serialno + ' with ' + formatteduuid)
-                    if serialno == formatteduuid:
-                        if hasattr(conf.backing, 'backingObjectId'):
-                            vm_storage_properties = {'uuid':conf.backing.uuid, 'backingObjectId':conf.backing.backingObjectId}
-                            return vm_storage_properties
-                            #break
-
-# This is a helper method that attempts to keep track of where in the vCenter resourse tree (or folder) that the method is
-def PrintVmInfo(vm, depth=1):
-    """
-    Print information for a particular virtual machine or recurse into a folder
-    or vApp with depth protection
-    """
-    maxdepth = 10
-    # if this is a group it will have children. if it does, recurse into them
-    # and then return
-    if hasattr(vm, 'childEntity'):
-        if depth > maxdepth:
-            return
-        vmList = vm.childEntity
-        for c in vmList:
-            PrintVmInfo(c, depth+1)
-        return 
-
-    # if this is a vApp, it likely contains child VMs
-    # (vApps can nest vApps, but it is hardly a common usecase, so ignore that)
-    if isinstance(vm, vim.VirtualApp):
-        vmList = vm.vm
-        for c in vmList:
-            PrintVmInfo(c, depth + 1)
-        return 
-    summary = vm.summary
-    uuid = summary.config.uuid 
-    vmmuuidlist.append(uuid)
\ No newline at end of file
+# This method retrieves the requested properties for every object matched by the filter in a single server side call
+# Large results are returned by vCenter in pages , these are followed until the result is complete
+def retrieve_properties(property_collector, filter_spec):
+    options = vmodl.query.PropertyCollector.RetrieveOptions()
+    result = property_collector.RetrievePropertiesEx([filter_spec], options)
+    objects = []
+    while result is not None:
+        objects.extend(result.objects)
+        if result.token is None:
+            break
+        result = property_collector.ContinueRetrievePropertiesEx(result.token)
+    return objects
+
+# A container view holds every virtual machine in the inventory , a property collector then returns the virtual
+# hardware of all of them at once rather than reading each virtual machine separately
+def retrieve_vm_devices(client):
+    container = client.viewManager.CreateContainerView(client.rootFolder, [vim.VirtualMachine], True)
+    try:
+        traversal_spec = vmodl.query.PropertyCollector.TraversalSpec(name='traverseEntities', path='view',
+                                                                      skip=False, type=vim.view.ContainerView)
+        object_spec = vmodl.query.PropertyCollector.ObjectSpec(obj=container, skip=True, selectSet=[traversal_spec])
+        property_spec = vmodl.query.PropertyCollector.PropertySpec(type=vim.VirtualMachine, all=False,
+                                                                    pathSet=['config.hardware.device'])
+        filter_spec = vmodl.query.PropertyCollector.FilterSpec(objectSet=[object_spec], propSet=[property_spec])
+        vm_devices = []
+        for vm_object in retrieve_properties(client.propertyCollector, filter_spec):
+            for prop in vm_object.propSet:
+                vm_devices.append(prop.val)
+        return vm_devices
+    finally:
+        container.Destroy()
+
+# The serial number presented to the operating system for a virtual disk is the disk backing uuid , prefixed with 3
+# Every wanted serial number found among the devices is added to the results
+def match_vvol_disks(devices, wanted_serials, results):
+    for conf in devices:
+        if hasattr(conf, 'backing'):
+            if hasattr(conf.backing, 'uuid') and conf.backing.uuid is not None:
+                formatteduuid = ("3" + str((conf.backing.uuid).replace("-",""))).lower()
+                if formatteduuid in wanted_serials and formatteduuid not in results:
+                    if hasattr(conf.backing, 'backingObjectId'):
+                        vm_storage_properties = {'uuid':conf.backing.uuid, 'backingObjectId':conf.backing.backingObjectId}
+                        results[formatteduuid] = vm_storage_properties
+    return results
+
+# The BIOS UUID read by the guest from /sys/class/dmi/id/product_uuid is normally the UUID vCenter knows the virtual
+# machine by. Older virtual hardware presents the first three fields to the guest in little endian byte order , so
+# the byte swapped form is tried as well
+def bios_uuid_candidates(vm_uuid):
+    vm_uuid = str(vm_uuid).strip().lower()
+    candidates = [vm_uuid]
+    fields = vm_uuid.split('-')
+    if len(fields) == 5:
+        try:
+            swapped = [bytes.fromhex(field)[::-1].hex() for field in fields[0:3]]
+        except ValueError:
+            return candidates
+        candidates.append('-'.join(swapped + fields[3:]))
+    return candidates
+
+# This method finds a single virtual machine by its BIOS UUID through the search index and returns its virtual hardware
+def find_vm_devices_by_uuid(client, vm_uuid):
+    for candidate in bios_uuid_candidates(vm_uuid):
+        vm = client.searchIndex.FindByUuid(uuid=candidate, vmSearch=True)
+        if vm is not None and vm.config is not None:
+            return vm.config.hardware.device
+    return None
+
+# This method looks for the virtual disks with the attribute "backing" matching the serial numbers presented to the operating system
+# If the UUID of the virtual machine is known only its own disks are checked , the virtual hardware of every virtual
+# machine is only retrieved for the serial numbers that are not attached to it
+def find_vvol_disks(client, serialnos, vm_uuid=None, inventory_devices=None):
+    wanted_serials = set(str(serialno).lower() for serialno in serialnos)
+    results = {}
+    if vm_uuid is not None:
+        devices = find_vm_devices_by_uuid(client, vm_uuid)
+        if devices is not None:
+            match_vvol_disks(devices, wanted_serials, results)
+    if len(results) < len(wanted_serials):
+        if inventory_devices is None:
+            inventory_devices = retrieve_vm_devices(client)
+        for devices in inventory_devices:
+            match_vvol_disks(devices, wanted_serials, results)
+            if len(results) == len(wanted_serials):
+                break
+    vm_disks = {}
+    for serialno in serialnos:
+        if str(serialno).lower() in results:
+            vm_disks[serialno] = results.get(str(serialno).lower())
+    return vm_disks
+
+# The resolver keeps all of its state on the instance so that several resolvers , or several threads sharing one
+# resolver , can look up disks at the same time. A single vCenter session is opened on first use and reused until
+# close is called. The virtual hardware of the inventory is retrieved at most once per resolver and then shared by
+# every lookup , each lookup builds and returns its own result
+# The inventory is collected by vCenter through a container view , so no folder traversal is done on the client
+class VSphereResolver:
+
+    def __init__(self, vcenter):
+        self._vcenter = vcenter
+        self._si = None
+        self._inventory_devices = None
+        self._session_lock = threading.Lock()
+        self._inventory_lock = threading.Lock()
+        atexit.register(self.close)
+
+    def _client(self):
+        with self._session_lock:
+            if self._si is None:
+                requests.packages.urllib3.disable_warnings()
+                context = ssl._create_unverified_context()
+                self._si = SmartConnect(host=self._vcenter.get('address'),
+                                port=443,
+                                user=self._vcenter.get('vc_user'),
+                                pwd=self._vcenter.get('vc_pass'),
+                                sslContext=context)
+            return self._si.RetrieveContent()
+
+    def _inventory(self, client):
+        with self._inventory_lock:
+            if self._inventory_devices is None:
+                self._inventory_devices = retrieve_vm_devices(client)
+            return self._inventory_devices
+
+    # A dictionary of serial number to the disk backing uuid and backingObjectId is returned , serial numbers that
+    # were not found are left out
+    def resolve(self, serialnos, vm_uuid=None):
+        client = self._client()
+        vm_disks = find_vvol_disks(client, serialnos, vm_uuid, inventory_devices=[])
+        missing = [serialno for serialno in serialnos if serialno not in vm_disks]
+        if len(missing) > 0:
+            vm_disks.update(find_vvol_disks(client, missing, None, inventory_devices=self._inventory(client)))
+        return vm_disks
+
+    def close(self):
+        with self._session_lock:
+            if self._si is not None:
+                Disconnect(self._si)
+                self._si = None
+            self._inventory_devices = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+# This method logs into the vCenter server once , resolves every serial number in a single pass and logs out again
+def vsphere_get_vvol_disk_identifiers_batch(serialnos, vcenter, vm_uuid=None):
+    with VSphereResolver(vcenter) as resolver:
+        return resolver.resolve(serialnos, vm_uuid)
+
+# This method resolves a single serial number presented to the operating system to its virtual disk
+def vsphere_get_vvol_disk_identifiers(serialno, vcenter, vm_uuid=None):
+    return vsphere_get_vvol_disk_identifiers_batch([serialno], vcenter, vm_uuid).get(serialno)